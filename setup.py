@@ -36,11 +36,17 @@ setup(
         "vfs",
     ],
     install_requires=[
+        "numpy",
         "opencv-python",
         "pyyaml",
         "opex",
         "redis",
     ],
+    extras_require={
+        "fast": ["orjson", "hiredis"],
+        "pyav": ["av"],
+        "inotify": ["inotify_simple"],
+    },
     version="0.0.9",
     author='Peter Reutemann',
     author_email='fracpete@waikato.ac.nz',
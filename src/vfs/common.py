@@ -1,9 +1,25 @@
+import itertools
 import os
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from yaml import dump
 
 from vfs.logging import log
-from vfs.predictions import load_roiscsv, load_opexjson
 
-IMAGE_EXTENSIONS = [".jpg", ".png"]
+try:
+    # libyaml-based emitter, considerably faster than the pure-Python one
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+IMAGE_EXTENSIONS = frozenset([".jpg", ".jpeg", ".png"])
 """ the supported image types. """
 
 INPUT_IMAGE_DIR = "image_dir"
@@ -17,16 +33,117 @@ ANALYSIS_OPEXJSON = "opex_json"
 ANALYSIS_TYPES = [ANALYSIS_ROISCSV, ANALYSIS_OPEXJSON]
 """ The available analysis file types. """
 
+ANALYSIS_IMAGE_JPG = "jpg"
+ANALYSIS_IMAGE_PNG = "png"
+ANALYSIS_IMAGE_BMP = "bmp"
+ANALYSIS_IMAGE_NPY = "npy"
+ANALYSIS_IMAGE_TYPES = [ANALYSIS_IMAGE_JPG, ANALYSIS_IMAGE_PNG, ANALYSIS_IMAGE_BMP, ANALYSIS_IMAGE_NPY]
+""" The available image types for presenting frames to the image analysis framework. """
+
 OUTPUT_JPG = "jpg"
 OUTPUT_MJPG = "mjpg"
 OUTPUT_TYPES = [OUTPUT_JPG, OUTPUT_MJPG]
 """ The available output types. """
 
+METADATA_YAML = "yaml"
+METADATA_JSON = "json"
+METADATA_FORMATS = [METADATA_YAML, METADATA_JSON]
+""" The available formats for the metadata files. """
+
+HW_DECODE_NONE = "none"
+HW_DECODE_ANY = "any"
+HW_DECODE_VAAPI = "vaapi"
+HW_DECODE_D3D11 = "d3d11"
+HW_DECODE_QSV = "qsv"
+HW_DECODE_TYPES = [HW_DECODE_NONE, HW_DECODE_ANY, HW_DECODE_VAAPI, HW_DECODE_D3D11, HW_DECODE_QSV]
+""" The available types of hardware acceleration for decoding videos. """
+
+DECODER_OPENCV = "opencv"
+DECODER_PYAV = "pyav"
+DECODER_GSTREAMER = "gstreamer"
+DECODERS = [DECODER_OPENCV, DECODER_PYAV, DECODER_GSTREAMER]
+""" The available decoders for videos. """
+
 ANALYSIS_FORMAT = "%06d.EXT"
 """ The file name format to use for the image analysis framework. """
 
+ANALYSIS_STEM_FORMAT = ANALYSIS_FORMAT.replace(".EXT", "")
+""" The file name format without extension, derived from ANALYSIS_FORMAT. """
+
+JPEG_QUALITY = 95
+""" the default quality (0-100) for encoding JPEG images, same as OpenCV's default. """
+
+WRITER_QUEUE_SIZE = 32
+""" the maximum number of frames to queue up for the background video writer. """
+
+PARALLEL_SCAN_MIN = 200
+""" the minimum number of candidate images in a directory before using multiple threads for scanning. """
+
+PREFETCH_THREADS = 2
+""" the number of threads to use for reading images ahead when processing an image dir. """
+
+
+def image_write_params(filename, jpeg_quality=JPEG_QUALITY, jpeg_optimize=False):
+    """
+    Returns the parameters for cv2.imwrite for the specified file.
+
+    :param filename: the image file to write, the extension determines the parameters
+    :type filename: str
+    :param jpeg_quality: the quality (0-100) to use for JPEG images
+    :type jpeg_quality: int
+    :param jpeg_optimize: whether to use optimized Huffman tables for JPEG images (smaller files, slightly slower)
+    :type jpeg_optimize: bool
+    :return: the parameters
+    :rtype: list
+    """
+    import cv2
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in (".jpg", ".jpeg"):
+        result = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        if jpeg_optimize:
+            # OpenCV expects an int, not a bool
+            result.extend([cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        return result
+    return []
+
+
+def resize_frame(frame, max_dim):
+    """
+    Scales down the frame if its width or height exceeds the maximum dimension, keeping the aspect ratio.
+
+    :param frame: the frame to scale
+    :type frame: ndarray
+    :param max_dim: the maximum width/height, no scaling if <= 0
+    :type max_dim: int
+    :return: tuple of (potentially) scaled frame and the scale factor that was applied (1.0 if not scaled)
+    :rtype: tuple
+    """
+    import cv2
+
+    if max_dim <= 0:
+        return frame, 1.0
+    height, width = frame.shape[:2]
+    if max(height, width) <= max_dim:
+        return frame, 1.0
+    scale = max_dim / max(height, width)
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA), scale
+
+
+def _is_file(entry):
+    """
+    Returns whether the directory entry represents a file.
+
+    :param entry: the entry to check
+    :type entry: os.DirEntry
+    :return: whether it is a file
+    :rtype: bool
+    """
+    return entry.is_file()
+
 
-def list_images(image_path, verbose=False):
+def list_images(image_path, verbose=False, num_threads=1):
     """
     Lists the images in the specified directory and returns a sorted list of
     absolute file names.
@@ -35,21 +152,1089 @@ def list_images(image_path, verbose=False):
     :type image_path: str
     :param verbose: whether to be verbose
     :type verbose: bool
+    :param num_threads: the number of threads to use for checking whether the entries are files (eg to
+                        hide the latency of network file systems), only used for larger directories
+    :type num_threads: int
     :return: the list of absolute file names
     :rtype: list
     """
-    result = []
     if verbose:
         log("Looking for images in: %s" % image_path)
-    for f in os.listdir(image_path):
-        full = os.path.join(image_path, f)
-        if not os.path.isfile(full):
-            continue
-        ext = os.path.splitext(full)[1].lower()
-        if ext not in IMAGE_EXTENSIONS:
-            continue
-        result.append(full)
+
+    # check extension first, as is_file() may require a stat call
+    candidates = []
+    with os.scandir(image_path) as it:
+        for entry in it:
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in IMAGE_EXTENSIONS:
+                candidates.append(entry)
+
+    if (num_threads > 1) and (len(candidates) >= PARALLEL_SCAN_MIN):
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            is_file = list(executor.map(_is_file, candidates))
+    else:
+        is_file = [_is_file(entry) for entry in candidates]
+    result = [entry.path for entry, f in zip(candidates, is_file) if f]
     result.sort()
+
     if verbose:
         log("# of images found: %d" % len(result))
     return result
+
+
+def _hw_acceleration(hw_decode):
+    """
+    Returns the OpenCV constant for the type of hardware acceleration.
+
+    :param hw_decode: the type of hardware acceleration, HW_DECODE_TYPES
+    :type hw_decode: str
+    :return: the OpenCV constant
+    :rtype: int
+    """
+    import cv2
+
+    if hw_decode == HW_DECODE_NONE:
+        return cv2.VIDEO_ACCELERATION_NONE
+    elif hw_decode == HW_DECODE_ANY:
+        return cv2.VIDEO_ACCELERATION_ANY
+    elif hw_decode == HW_DECODE_VAAPI:
+        return cv2.VIDEO_ACCELERATION_VAAPI
+    elif hw_decode == HW_DECODE_D3D11:
+        return cv2.VIDEO_ACCELERATION_D3D11
+    elif hw_decode == HW_DECODE_QSV:
+        return cv2.VIDEO_ACCELERATION_MFX
+    else:
+        raise Exception("Unhandled hardware decoding type: %s" % hw_decode)
+
+
+class PyAVCapture(object):
+    """
+    Decodes a video with PyAV, mimicking the parts of cv2.VideoCapture that are in use.
+    Uses frame-level threading in the decoder and converts only the retrieved frames to BGR.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the video.
+
+        :param path: the video file to read
+        :type path: str
+        """
+        try:
+            import av
+        except ImportError:
+            raise Exception("PyAV is not installed, cannot use decoder '%s' (install with: pip install av)" % DECODER_PYAV)
+        self.container = av.open(path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self.frames = self.container.decode(self.stream)
+        self.frame = None
+
+    def isOpened(self):
+        """
+        Returns whether the video is still open.
+
+        :return: True if open
+        :rtype: bool
+        """
+        return self.frames is not None
+
+    def grab(self):
+        """
+        Decodes the next frame.
+
+        :return: whether a frame was decoded
+        :rtype: bool
+        """
+        if self.frames is None:
+            return False
+        try:
+            self.frame = next(self.frames)
+            return True
+        except StopIteration:
+            self.release()
+            return False
+
+    def retrieve(self):
+        """
+        Returns the last decoded frame as BGR image.
+
+        :return: tuple of success and frame
+        :rtype: tuple
+        """
+        if self.frame is None:
+            return False, None
+        return True, self.frame.to_ndarray(format="bgr24")
+
+    def read(self):
+        """
+        Decodes and returns the next frame.
+
+        :return: tuple of success and frame
+        :rtype: tuple
+        """
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def get(self, prop):
+        """
+        Returns the property, supports width, height, frame rate and number of frames.
+
+        :param prop: the cv2.CAP_PROP_* property to return
+        :type prop: int
+        :return: the value, 0 if not supported
+        :rtype: float
+        """
+        import cv2
+
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.stream.codec_context.width)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.stream.codec_context.height)
+        elif (prop == cv2.CAP_PROP_FPS) and (self.stream.average_rate is not None):
+            return float(self.stream.average_rate)
+        elif prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.stream.frames)
+        return 0.0
+
+    def release(self):
+        """
+        Closes the video.
+        """
+        if self.frames is not None:
+            self.frames = None
+            self.frame = None
+            self.container.close()
+
+
+def has_gstreamer():
+    """
+    Checks whether OpenCV was built with GStreamer support.
+
+    :return: True if GStreamer is available
+    :rtype: bool
+    """
+    import cv2
+
+    for line in cv2.getBuildInformation().split("\n"):
+        if line.strip().startswith("GStreamer:"):
+            return "YES" in line
+    return False
+
+
+def gstreamer_pipeline(input):
+    """
+    Returns the GStreamer pipeline for reading the input video. Video files get
+    decoded via decodebin (which picks hardware decoders if available) and
+    converted to BGR, anything else is assumed to be a pipeline already.
+
+    :param input: the video file or GStreamer pipeline ending in appsink
+    :type input: str
+    :return: the pipeline
+    :rtype: str
+    """
+    if os.path.isfile(input):
+        return 'filesrc location="%s" ! decodebin ! videoconvert ! video/x-raw,format=BGR ! appsink' \
+               % input.replace("\\", "\\\\").replace('"', '\\"')
+    return input
+
+
+def open_input(input, input_type, verbose=False, hw_decode=HW_DECODE_NONE, decoder=DECODER_OPENCV, capture_buffer=0,
+               scan_threads=1):
+    """
+    Opens the input, i.e., lists the images or opens the video/webcam.
+
+    :param input: the input dir, video, webcam ID or GStreamer pipeline (gstreamer decoder, instead of video)
+    :type input: str
+    :param input_type: the type of input, INPUT_TYPES
+    :type input_type: str
+    :param hw_decode: the type of hardware acceleration to use for decoding videos (opencv decoder), HW_DECODE_TYPES
+    :type hw_decode: str
+    :param decoder: the decoder to use for videos, DECODERS
+    :type decoder: str
+    :param capture_buffer: the number of frames to buffer when capturing from a webcam, uses the backend's default if <= 0
+    :type capture_buffer: int
+    :param scan_threads: the number of threads to use for scanning the image dir, see list_images
+    :type scan_threads: int
+    :param verbose: whether to be verbose
+    :type verbose: bool
+    :return: tuple of video capture (cv2.VideoCapture or PyAVCapture) and list of image files, either one is None
+    :rtype: tuple
+    """
+    # imported here, so that list_images can be used without loading OpenCV
+    import cv2
+
+    if input_type not in INPUT_TYPES:
+        raise Exception("Unknown input type: %s" % input_type)
+    if decoder not in DECODERS:
+        raise Exception("Unknown decoder: %s" % decoder)
+    cap = None
+    files = None
+    if input_type == INPUT_IMAGE_DIR:
+        files = list_images(input, verbose=verbose, num_threads=scan_threads)
+    elif input_type == INPUT_VIDEO:
+        if verbose:
+            log("Opening input video: %s" % input)
+        if decoder == DECODER_PYAV:
+            cap = PyAVCapture(input)
+        elif decoder == DECODER_GSTREAMER:
+            # the pipeline determines the decoder, e.g., nvh264dec (NVDEC), vaapih264dec or v4l2h264dec
+            if not has_gstreamer():
+                raise Exception("OpenCV was built without GStreamer support, cannot use decoder '%s'!" % DECODER_GSTREAMER)
+            cap = cv2.VideoCapture(gstreamer_pipeline(input), cv2.CAP_GSTREAMER)
+        elif hw_decode == HW_DECODE_NONE:
+            cap = cv2.VideoCapture(input)
+        else:
+            # acceleration must be requested when opening, setting it afterwards has no effect
+            cap = cv2.VideoCapture(input, cv2.CAP_FFMPEG,
+                                   [cv2.CAP_PROP_HW_ACCELERATION, _hw_acceleration(hw_decode)])
+            if verbose:
+                log("Hardware acceleration in use: %d" % int(cap.get(cv2.CAP_PROP_HW_ACCELERATION)))
+    elif input_type == INPUT_WEBCAM:
+        if verbose:
+            log("Opening webcam: %s" % input)
+        cap = cv2.VideoCapture(int(input))
+        if capture_buffer > 0:
+            # a small buffer means the frames are more recent, not all backends support this
+            if not cap.set(cv2.CAP_PROP_BUFFERSIZE, capture_buffer):
+                log("Failed to set webcam buffer size to: %d" % capture_buffer)
+            elif verbose:
+                log("Webcam buffer size: %d" % int(cap.get(cv2.CAP_PROP_BUFFERSIZE)))
+    else:
+        raise Exception("Unhandled input type: %s" % input_type)
+    return cap, files
+
+
+def seek_video(cap, frameno, verbose=False):
+    """
+    Positions the video so that the next frame read is the specified one, which avoids
+    decoding all the frames before it. Only supported for videos opened by OpenCV
+    (not via GStreamer pipelines).
+
+    :param cap: the video capture to position
+    :type cap: cv2.VideoCapture or PyAVCapture
+    :param frameno: the 0-based index of the frame to position the video at
+    :type frameno: int
+    :param verbose: whether to be verbose
+    :type verbose: bool
+    :return: whether the video got positioned, the video needs to be read from the current position if False
+    :rtype: bool
+    """
+    import cv2
+
+    if not isinstance(cap, cv2.VideoCapture):
+        return False
+    if cap.getBackendName() == "GSTREAMER":
+        return False
+    if not cap.set(cv2.CAP_PROP_POS_FRAMES, frameno):
+        return False
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != frameno:
+        if verbose:
+            log("Failed to position video at frame #%d, reading from start" % (frameno + 1))
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return False
+    if verbose:
+        log("Positioned video at frame #%d" % (frameno + 1))
+    return True
+
+
+class ImagePrefetcher(object):
+    """
+    Reads the images of an image dir ahead in background threads, so that
+    decoding the next images overlaps with processing the current one.
+    """
+
+    def __init__(self, files, num_ahead, num_threads=PREFETCH_THREADS):
+        """
+        Initializes the prefetcher.
+
+        :param files: the list of image files
+        :type files: list
+        :param num_ahead: the number of images to read ahead
+        :type num_ahead: int
+        :param num_threads: the number of threads to use for reading
+        :type num_threads: int
+        """
+        self.files = files
+        self.num_ahead = num_ahead
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.pending = dict()
+        self.next_index = 0
+
+    def read(self, index):
+        """
+        Returns the image at the specified index and queues up the following ones.
+        The images must be requested with increasing indices.
+
+        :param index: the 0-based index of the image to read
+        :type index: int
+        :return: the image, None if it failed to read
+        :rtype: ndarray
+        """
+        import cv2
+
+        # drop any images that got skipped
+        for i in [i for i in self.pending if i < index]:
+            self.pending.pop(i).cancel()
+        end = min(len(self.files), index + self.num_ahead + 1)
+        for i in range(max(index, self.next_index), end):
+            self.pending[i] = self.executor.submit(cv2.imread, self.files[i])
+        self.next_index = max(self.next_index, end)
+        future = self.pending.pop(index, None)
+        if future is None:
+            return cv2.imread(self.files[index])
+        return future.result()
+
+    def close(self):
+        """
+        Cancels any pending reads and shuts down the threads.
+        """
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+
+class BackgroundReader(object):
+    """
+    Reads the frames from a video capture in a separate thread, so that decoding
+    the next frames overlaps with processing the current one. The thread only grabs
+    the frames and retrieves (decodes/converts) just the selected ones, i.e., every
+    nth frame within the frame window, using the same counting as the processing loop.
+    """
+
+    def __init__(self, cap, queue_size, nth_frame=1, count=0, frames_count=0, from_frame=0):
+        """
+        Initializes the reader and starts the background thread.
+
+        :param cap: the video capture to read from
+        :type cap: cv2.VideoCapture
+        :param queue_size: the maximum number of frames to read ahead
+        :type queue_size: int
+        :param nth_frame: every nth frame gets retrieved, 1 for retrieving all frames
+        :type nth_frame: int
+        :param count: the initial value of the counter for the nth frame
+        :type count: int
+        :param frames_count: the number of frames already read (e.g., when seeking)
+        :type frames_count: int
+        :param from_frame: the first frame (1-based) that can get selected, <= 0 for all
+        :type from_frame: int
+        """
+        self.cap = cap
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.nth_frame = nth_frame
+        self.count = count
+        self.frames_count = frames_count
+        self.from_frame = from_frame
+        self.frame = None
+        self.error = None
+        self.finished = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """
+        Reads frames until the end of the video is reached or the reader gets released.
+        """
+        grab = self.cap.grab
+        retrieve = self.cap.retrieve
+        nth_frame = self.nth_frame
+        from_frame = self.from_frame
+        count = self.count
+        frames_count = self.frames_count
+        while not self.stopped:
+            frame = None
+            try:
+                retval = grab()
+                if retval:
+                    count += 1
+                    frames_count += 1
+                    if (count >= nth_frame) and ((from_frame <= 0) or (frames_count >= from_frame)):
+                        count = 0
+                        retval, frame = retrieve()
+            except Exception as e:
+                self.error = e
+                retval, frame = False, None
+            self.queue.put((retval, frame))
+            if not retval:
+                break
+
+    def _next(self):
+        """
+        Returns the next entry from the queue, blocks until it is available.
+
+        :return: tuple of success and frame (None if not retrieved)
+        :rtype: tuple
+        """
+        if self.finished:
+            return False, None
+        retval, frame = self.queue.get()
+        if not retval:
+            self.finished = True
+            if self.error is not None:
+                raise Exception("Failed to read frame: %s" % str(self.error))
+        return retval, frame
+
+    def grab(self):
+        """
+        Advances to the next frame, blocks until it is available.
+
+        :return: True if successful
+        :rtype: bool
+        """
+        retval, self.frame = self._next()
+        return retval
+
+    def retrieve(self):
+        """
+        Returns the frame for the last grab, only available for selected frames.
+
+        :return: tuple of success and frame
+        :rtype: tuple
+        """
+        return self.frame is not None, self.frame
+
+    def isOpened(self):
+        """
+        Returns whether there are still frames to read.
+
+        :return: True if more frames can be read
+        :rtype: bool
+        """
+        return not self.finished
+
+    def read(self):
+        """
+        Returns the next frame, blocks until it is available. The frame is None
+        if it was not selected for retrieval (see nth_frame).
+
+        :return: tuple of success and frame
+        :rtype: tuple
+        """
+        return self._next()
+
+    def get(self, prop):
+        """
+        Returns the property of the underlying video capture.
+
+        :param prop: the property to return
+        :type prop: int
+        :return: the value
+        :rtype: float
+        """
+        return self.cap.get(prop)
+
+    def release(self):
+        """
+        Stops the background thread and releases the video capture.
+        """
+        self.stopped = True
+        # unblock the thread in case the queue is full
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.finished = True
+        self.cap.release()
+
+
+class BackgroundVideoWriter(object):
+    """
+    Wraps a video writer and writes the frames in a separate thread, to decouple
+    the encoding and disk I/O from reading/processing the frames.
+    """
+
+    def __init__(self, writer, queue_size=WRITER_QUEUE_SIZE):
+        """
+        Initializes the writer and starts the background thread.
+
+        :param writer: the actual video writer to use
+        :type writer: cv2.VideoWriter
+        :param queue_size: the maximum number of frames to queue up before write blocks
+        :type queue_size: int
+        """
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """
+        Writes the queued frames until the None sentinel is encountered.
+        """
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.writer.write(frame)
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self):
+        """
+        Raises the exception if the background thread failed to write a frame.
+        """
+        if self.error is not None:
+            raise Exception("Failed to write video frame: %s" % str(self.error))
+
+    def write(self, frame):
+        """
+        Queues the frame for writing. The frame must not be modified afterwards.
+
+        :param frame: the frame to write
+        :type frame: ndarray
+        """
+        self._check_error()
+        self.queue.put(frame)
+
+    def release(self):
+        """
+        Writes all remaining frames and releases the video writer.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.release()
+        self._check_error()
+
+
+class FrameWriterPool(object):
+    """
+    Writes frames via write_frame (or the supplied function) using a pool of threads,
+    to overlap the encoding and disk I/O with reading/processing the next frames.
+    """
+
+    def __init__(self, num_threads, write_fn=None):
+        """
+        Initializes the pool.
+
+        :param num_threads: the number of threads to use
+        :type num_threads: int
+        :param write_fn: the function to use for writing the frames, uses write_frame if None
+        :type write_fn: callable
+        """
+        self.write_fn = write_frame if (write_fn is None) else write_fn
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        # limits the number of frames held in memory
+        self.semaphore = threading.BoundedSemaphore(num_threads * 2)
+        self.error = None
+
+    def _done(self, future):
+        """
+        Gets called when a frame has been written.
+
+        :param future: the finished job
+        :type future: concurrent.futures.Future
+        """
+        if (future.exception() is not None) and (self.error is None):
+            self.error = future.exception()
+        self.semaphore.release()
+
+    def _check_error(self):
+        """
+        Raises the exception if a background thread failed to write a frame.
+        """
+        if self.error is not None:
+            raise Exception("Failed to write frame: %s" % str(self.error))
+
+    def write(self, *args, **kwargs):
+        """
+        Queues the frame for writing, blocks if too many frames are still pending.
+        Takes the same parameters as the write function. The frame must not be modified afterwards.
+        """
+        self._check_error()
+        self.semaphore.acquire()
+        future = self.executor.submit(self.write_fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+
+    def close(self):
+        """
+        Waits for all pending frames to be written and shuts down the pool.
+        """
+        self.executor.shutdown(wait=True)
+        self._check_error()
+
+
+def check_same_filesystem(tmp_dir, target_dir):
+    """
+    Ensures that the tmp directory is on the same filesystem as the target directory,
+    as moving the files into the target directory via os.rename fails otherwise.
+    Directories that don't exist (yet) are not checked.
+
+    :param tmp_dir: the tmp directory
+    :type tmp_dir: str
+    :param target_dir: the directory that the files get moved to
+    :type target_dir: str
+    """
+    if (not os.path.isdir(tmp_dir)) or (not os.path.isdir(target_dir)):
+        return
+    if os.stat(tmp_dir).st_dev != os.stat(target_dir).st_dev:
+        raise Exception("Tmp directory '%s' must be on the same filesystem as '%s'!" % (tmp_dir, target_dir))
+
+
+def open_output(output, output_type, output_format, output_fps, cap, verbose=False, jpeg_quality=JPEG_QUALITY):
+    """
+    Opens the output video or checks the output format for the images.
+
+    :param output: the output video or directory for output images
+    :type output: str
+    :param output_type: the type of output to generate, see OUTPUT_TYPES
+    :type output_type: str
+    :param output_format: the file name format to use for the image files
+    :type output_format: str
+    :param output_fps: the frames-per-second to use when generating an output video
+    :type output_fps: int
+    :param cap: the video capture to obtain the frame dimensions from
+    :type cap: cv2.VideoCapture
+    :param verbose: whether to be verbose
+    :type verbose: bool
+    :param jpeg_quality: the JPEG quality (0-100) to use for the video frames
+    :type jpeg_quality: int
+    :return: the video writer, None if outputting images
+    :rtype: BackgroundVideoWriter
+    """
+    import cv2
+
+    out = None
+    if output_type not in OUTPUT_TYPES:
+        raise Exception("Unknown output type: %s" % output_type)
+    if output_type == OUTPUT_MJPG:
+        if verbose:
+            log("Opening output video: %s" % output)
+        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        # OpenCV's built-in MJPEG writer, unlike the FFMPEG backend, supports setting the JPEG quality
+        out = cv2.VideoWriter(output, cv2.CAP_OPENCV_MJPEG, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), output_fps,
+                              (frame_width, frame_height))
+        if not out.isOpened():
+            raise Exception("Failed to open output video: %s" % output)
+        if not out.set(cv2.VIDEOWRITER_PROP_QUALITY, jpeg_quality):
+            log("Video writer does not support setting the JPEG quality, ignoring: %d" % jpeg_quality)
+        out = BackgroundVideoWriter(out)
+    elif output_type == OUTPUT_JPG:
+        if (output_format % 1) == output_format:
+            raise Exception("Output format does not expand integers: %s" % output_format)
+    else:
+        raise Exception("Unhandled output type: %s" % output_type)
+    return out
+
+
+_tmp_counter = itertools.count()
+""" for generating unique names for temporary files. """
+
+
+def _tmp_name(path):
+    """
+    Generates a unique name for a hidden, temporary file in the same directory as the target.
+
+    :param path: the target file
+    :type path: str
+    :return: the name of the temporary file (without directory)
+    :rtype: str
+    """
+    return ".%s.%d.%d.tmp" % (os.path.basename(path), os.getpid(), next(_tmp_counter))
+
+
+def _write_fd(fd, data):
+    """
+    Writes all the data to the file descriptor.
+
+    :param fd: the file descriptor to write to
+    :type fd: int
+    :param data: the data to write
+    :type data: bytes or ndarray
+    """
+    view = memoryview(data).cast("B")
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+def _link_tmpfile(path, data, dir_fd):
+    """
+    Writes the data to an unnamed file (O_TMPFILE) in the directory of the target,
+    links it in under a unique temporary name once completely written and then
+    renames it to the target, replacing any existing file.
+
+    :param path: the file to write
+    :type path: str
+    :param data: the data to write
+    :type data: bytes or ndarray
+    :param dir_fd: the file descriptor of the target's directory
+    :type dir_fd: int
+    :return: False if not supported (filesystem, kernel, no /proc), nothing got written in that case
+    :rtype: bool
+    """
+    try:
+        fd = os.open(".", os.O_TMPFILE | os.O_WRONLY, 0o666, dir_fd=dir_fd)
+    except OSError:
+        return False
+    try:
+        _write_fd(fd, data)
+        tmp = _tmp_name(path)
+        try:
+            # dst_dir_fd makes os.link use linkat with AT_SYMLINK_FOLLOW, required for linking the /proc entry
+            os.link("/proc/self/fd/%d" % fd, tmp, dst_dir_fd=dir_fd)
+        except OSError:
+            return False
+    finally:
+        os.close(fd)
+    try:
+        os.replace(tmp, os.path.basename(path), src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except OSError:
+        os.unlink(tmp, dir_fd=dir_fd)
+        raise
+    return True
+
+
+def _rename_tmpfile(path, data, dir_fd):
+    """
+    Writes the data to a uniquely named, hidden file in the directory of the target
+    and renames it to the target once completely written, replacing any existing file.
+
+    :param path: the file to write
+    :type path: str
+    :param data: the data to write
+    :type data: bytes or ndarray
+    :param dir_fd: the file descriptor of the target's directory
+    :type dir_fd: int
+    """
+    while True:
+        tmp = _tmp_name(path)
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666, dir_fd=dir_fd)
+            break
+        except FileExistsError:
+            continue
+    try:
+        try:
+            _write_fd(fd, data)
+        finally:
+            os.close(fd)
+        os.replace(tmp, os.path.basename(path), src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except OSError:
+        os.unlink(tmp, dir_fd=dir_fd)
+        raise
+
+
+def write_file(path, data):
+    """
+    Writes the data to the file, replacing any existing file. The file only becomes
+    visible under its name once completely written, so that other processes never
+    pick up partially written files. Where supported (Linux), the data gets written
+    to an unnamed file (O_TMPFILE), otherwise to a hidden temporary file; either
+    gets renamed to the target at the end.
+
+    :param path: the file to write
+    :type path: str
+    :param data: the data to write
+    :type data: bytes or ndarray
+    """
+    dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        if hasattr(os, "O_TMPFILE") and _link_tmpfile(path, data, dir_fd):
+            return
+        _rename_tmpfile(path, data, dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_image(path, frame, params):
+    """
+    Encodes the frame and writes it to the file via write_file.
+
+    :param path: the image file to write, the extension determines the format
+    :type path: str
+    :param frame: the frame to write
+    :type frame: ndarray
+    :param params: the parameters for the encoder, see image_write_params
+    :type params: list
+    """
+    import cv2
+
+    retval, buf = cv2.imencode(os.path.splitext(path)[1], frame, params)
+    if not retval:
+        raise Exception("Failed to encode image: %s" % path)
+    write_file(path, buf)
+
+
+def serialize_metadata(metadata, metadata_format=METADATA_YAML):
+    """
+    Turns the metadata into the content of a metadata file.
+
+    :param metadata: the metadata to serialize
+    :type metadata: dict
+    :param metadata_format: the format to use, see METADATA_FORMATS
+    :type metadata_format: str
+    :return: the serialized metadata
+    :rtype: bytes
+    """
+    if metadata_format == METADATA_YAML:
+        return dump(metadata, Dumper=SafeDumper).encode("utf-8")
+    elif metadata_format == METADATA_JSON:
+        result = json.dumps(metadata)
+        # orjson returns bytes, the json module a str
+        if isinstance(result, str):
+            result = result.encode("utf-8")
+        return result
+    else:
+        raise Exception("Unhandled metadata format: %s" % metadata_format)
+
+
+class FrameWriter(object):
+    """
+    Writes frames (and optional metadata) to the output directory. The file name
+    templates and encoder parameters get determined once, as is the method to use
+    for writing (with or without tmp directory).
+    """
+
+    def __init__(self, output, output_format, output_tmp, output_metadata,
+                 files=None, keep_original=False, verbose=False, jpeg_quality=JPEG_QUALITY, jpeg_optimize=False,
+                 metadata_format=METADATA_YAML):
+        """
+        Initializes the writer.
+
+        :param output: the directory for output images
+        :type output: str
+        :param output_format: the file name format to use for the image files
+        :type output_format: str
+        :param output_tmp: the tmp directory to write the output images to before moving them to the output directory
+        :type output_tmp: str
+        :param output_metadata: whether to output metadata as YAML/JSON file alongside JPG frames
+        :type output_metadata: bool
+        :param files: the list of image files when processing an image dir
+        :type files: list
+        :param keep_original: whether to keep the original filename when processing an image dir
+        :type keep_original: bool
+        :param verbose: whether to be verbose
+        :type verbose: bool
+        :param jpeg_quality: the quality (0-100) to use when writing JPEG images
+        :type jpeg_quality: int
+        :param jpeg_optimize: whether to use optimized Huffman tables when writing JPEG images
+        :type jpeg_optimize: bool
+        :param metadata_format: the format for the metadata files, see METADATA_FORMATS
+        :type metadata_format: str
+        """
+        if metadata_format not in METADATA_FORMATS:
+            raise Exception("Unknown metadata format: %s" % metadata_format)
+        self.output = output
+        self.output_tmp = output_tmp
+        self.output_metadata = output_metadata
+        self.verbose = verbose
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_optimize = jpeg_optimize
+        self.metadata_format = metadata_format
+        self.metadata_ext = "." + metadata_format
+        # keep original filename when using image_dir
+        self.files = files if keep_original else None
+        self.params = dict()
+        self.img_out = self._template(output, output_format)
+        self.meta_out = self._template(output, os.path.splitext(output_format)[0] + self.metadata_ext)
+        if output_tmp is not None:
+            self.img_tmp = self._template(output_tmp, output_format)
+            self.meta_tmp = self._template(output_tmp, os.path.splitext(output_format)[0] + self.metadata_ext)
+            self.write = self._write_tmp
+        else:
+            self.write = self._write_direct
+
+    def _template(self, directory, name):
+        """
+        Generates the template for the directory and file name format.
+
+        :param directory: the directory of the file
+        :type directory: str
+        :param name: the file name format
+        :type name: str
+        :return: the template
+        :rtype: str
+        """
+        return os.path.join(directory.replace("%", "%%"), name)
+
+    def _params(self, path):
+        """
+        Returns the encoder parameters for the file, cached per extension.
+
+        :param path: the image file to write
+        :type path: str
+        :return: the parameters
+        :rtype: list
+        """
+        ext = os.path.splitext(path)[1]
+        result = self.params.get(ext)
+        if result is None:
+            result = image_write_params(path, jpeg_quality=self.jpeg_quality, jpeg_optimize=self.jpeg_optimize)
+            self.params[ext] = result
+        return result
+
+    def _reuse_jpeg(self, path):
+        """
+        Returns whether a JPEG encoded with just the quality setting can be written as is to the file,
+        i.e., whether the file is a JPEG and no other encoder parameters are in use.
+
+        :param path: the image file to write
+        :type path: str
+        :return: whether the encoded JPEG can be used
+        :rtype: bool
+        """
+        return (not self.jpeg_optimize) and (os.path.splitext(path)[1].lower() in (".jpg", ".jpeg"))
+
+    def _original(self, directory, frameno, ext=None):
+        """
+        Returns the file in the directory using the original file name of the frame.
+
+        :param directory: the directory of the file
+        :type directory: str
+        :param frameno: the frame no
+        :type frameno: int
+        :param ext: the extension to use instead of the original one, ignored if None
+        :type ext: str
+        :return: the file name
+        :rtype: str
+        """
+        name = os.path.basename(self.files[frameno - 1])
+        if ext is not None:
+            name = os.path.splitext(name)[0] + ext
+        return os.path.join(directory, name)
+
+    def _write_tmp(self, frame, frameno, metadata, encoded=None):
+        """
+        Writes the frame (and optional metadata) to the tmp directory and then moves it into the output directory.
+
+        :param frame: the frame to write
+        :type frame: ndarray
+        :param frameno: the current frame no
+        :type frameno: int
+        :param metadata: the metadata to write, can be None
+        :type metadata: dict
+        :param encoded: the frame already encoded as JPEG with the writer's quality, gets used for JPEG files if possible
+        :type encoded: bytes or memoryview or ndarray
+        """
+        import cv2
+
+        if self.files is not None:
+            tmp_file = self._original(self.output_tmp, frameno)
+            out_file = self._original(self.output, frameno)
+        else:
+            tmp_file = self.img_tmp % frameno
+            out_file = self.img_out % frameno
+        if (encoded is not None) and self._reuse_jpeg(out_file):
+            with open(tmp_file, "wb") as fp:
+                fp.write(encoded)
+        else:
+            cv2.imwrite(tmp_file, frame, self._params(out_file))
+        os.rename(tmp_file, out_file)
+        if self.verbose:
+            log("Frame written to: %s" % out_file)
+        if self.output_metadata and (metadata is not None):
+            if self.files is not None:
+                tmp_file = self._original(self.output_tmp, frameno, ext=self.metadata_ext)
+                out_file = self._original(self.output, frameno, ext=self.metadata_ext)
+            else:
+                tmp_file = self.meta_tmp % frameno
+                out_file = self.meta_out % frameno
+            with open(tmp_file, "wb") as mf:
+                mf.write(serialize_metadata(metadata, self.metadata_format))
+            os.rename(tmp_file, out_file)
+            if self.verbose:
+                log("Meta-data written to: %s" % out_file)
+
+    def _write_direct(self, frame, frameno, metadata, encoded=None):
+        """
+        Writes the frame (and optional metadata) straight to the output directory.
+
+        :param frame: the frame to write
+        :type frame: ndarray
+        :param frameno: the current frame no
+        :type frameno: int
+        :param metadata: the metadata to write, can be None
+        :type metadata: dict
+        :param encoded: the frame already encoded as JPEG with the writer's quality, gets used for JPEG files if possible
+        :type encoded: bytes or memoryview or ndarray
+        """
+        if self.files is not None:
+            out_file = self._original(self.output, frameno)
+        else:
+            out_file = self.img_out % frameno
+        if (encoded is not None) and self._reuse_jpeg(out_file):
+            write_file(out_file, encoded)
+        else:
+            write_image(out_file, frame, self._params(out_file))
+        if self.verbose:
+            log("Frame written to: %s" % out_file)
+        if self.output_metadata and (metadata is not None):
+            if self.files is not None:
+                out_file = self._original(self.output, frameno, ext=self.metadata_ext)
+            else:
+                out_file = self.meta_out % frameno
+            write_file(out_file, serialize_metadata(metadata, self.metadata_format))
+            if self.verbose:
+                log("Meta-data written to: %s" % out_file)
+
+
+def write_frame(frame, frameno, metadata, output, output_format, output_tmp, output_metadata,
+                files=None, keep_original=False, verbose=False, jpeg_quality=JPEG_QUALITY, jpeg_optimize=False,
+                metadata_format=METADATA_YAML):
+    """
+    Writes the frame (and optional metadata) to the output directory.
+
+    :param frame: the frame to write
+    :type frame: ndarray
+    :param frameno: the current frame no
+    :type frameno: int
+    :param metadata: the metadata to write, can be None
+    :type metadata: dict
+    :param output: the directory for output images
+    :type output: str
+    :param output_format: the file name format to use for the image files
+    :type output_format: str
+    :param output_tmp: the tmp directory to write the output images to before moving them to the output directory
+    :type output_tmp: str
+    :param output_metadata: whether to output metadata as YAML/JSON file alongside JPG frames
+    :type output_metadata: bool
+    :param files: the list of image files when processing an image dir
+    :type files: list
+    :param keep_original: whether to keep the original filename when processing an image dir
+    :type keep_original: bool
+    :param verbose: whether to be verbose
+    :type verbose: bool
+    :param jpeg_quality: the quality (0-100) to use when writing JPEG images
+    :type jpeg_quality: int
+    :param jpeg_optimize: whether to use optimized Huffman tables when writing JPEG images
+    :type jpeg_optimize: bool
+    :param metadata_format: the format for the metadata files, see METADATA_FORMATS
+    :type metadata_format: str
+    """
+    writer = FrameWriter(output, output_format, output_tmp, output_metadata, files=files,
+                         keep_original=keep_original, verbose=verbose, jpeg_quality=jpeg_quality,
+                         jpeg_optimize=jpeg_optimize, metadata_format=metadata_format)
+    writer.write(frame, frameno, metadata)
+
+
+def copy_file(path, output, output_tmp, verbose=False):
+    """
+    Copies the image file as is to the output directory, keeping its name.
+
+    :param path: the image file to copy
+    :type path: str
+    :param output: the directory for output images
+    :type output: str
+    :param output_tmp: the tmp directory to copy the file to before moving it to the output directory
+    :type output_tmp: str
+    :param verbose: whether to be verbose
+    :type verbose: bool
+    """
+    name = os.path.basename(path)
+    out_file = os.path.join(output, name)
+    if output_tmp is not None:
+        tmp_file = os.path.join(output_tmp, name)
+        shutil.copyfile(path, tmp_file)
+        os.rename(tmp_file, out_file)
+    else:
+        shutil.copyfile(path, out_file)
+    if verbose:
+        log("Frame copied to: %s" % out_file)
@@ -1,10 +1,22 @@
-from datetime import datetime
+import time
+
+_cache = (None, None)
+""" the second and the timestamp prefix (without microseconds) generated for it, replaced in a single assignment
+so that threads never see the second and prefix of different updates. """
 
 
 def log(*args):
     """
     Just outputs the arguments with a timestamp.
+    The date/time part of the timestamp only gets formatted once per second.
 
     :param args: the arguments to log
     """
-    print(*("%s - " % str(datetime.now()), *args))
+    global _cache
+    now = time.time()
+    second = int(now)
+    last_second, prefix = _cache
+    if second != last_second:
+        prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        _cache = (second, prefix)
+    print(*("%s.%06d - " % (prefix, int((now - second) * 1e6)), *args))
@@ -1,13 +1,32 @@
 import csv
 import io
+import json
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
 from vfs.logging import log
-from opex import ObjectPredictions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CACHE_SIZE = 256
+""" the maximum number of parsed analysis files to cache, evaluated on every load, 0 disables the cache. """
+
+CACHE_ENV = "VFS_PREDICTION_CACHE"
+""" the environment variable for disabling the cache of parsed analysis files (when set to 0). """
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
 
 
 class Prediction(object):
     """
     Encapsulates a single prediction.
     """
+    __slots__ = ("index", "label", "score", "data", "coords")
 
     def __init__(self, index, label, score, data=None, coords=None):
         """
@@ -40,6 +59,83 @@ class Prediction(object):
         return "%d: %s = %f" % (self.index, self.label, self.score)
 
 
+class PredictionsBatch(object):
+    """
+    Column-oriented representation of a list of predictions, with the
+    coordinates, scores and labels stored in numpy arrays.
+    """
+    __slots__ = ("coords", "scores", "labels")
+
+    def __init__(self, coords, scores, labels):
+        """
+        Initializes the batch.
+
+        :param coords: the (x0, y0, x1, y1) coordinates of all the predictions that have coordinates, shape (N, 4)
+        :type coords: ndarray
+        :param scores: the scores of all the predictions
+        :type scores: ndarray
+        :param labels: the labels of all the predictions
+        :type labels: ndarray
+        """
+        self.coords = coords
+        self.scores = scores
+        self.labels = labels
+
+    def __len__(self):
+        """
+        Returns the number of predictions in the batch.
+
+        :return: the number of predictions
+        :rtype: int
+        """
+        return len(self.scores)
+
+    @classmethod
+    def from_predictions(cls, predictions):
+        """
+        Turns the list of predictions into a batch.
+
+        :param predictions: the list of Prediction objects
+        :type predictions: list
+        :return: the batch
+        :rtype: PredictionsBatch
+        """
+        coords = np.fromiter((c for p in predictions if p.coords is not None for c in p.coords),
+                             dtype=np.int32).reshape(-1, 4)
+        scores = np.array([p.score for p in predictions], dtype=np.float64)
+        labels = np.array([p.label for p in predictions], dtype=object)
+        return cls(coords, scores, labels)
+
+    def scaled(self, factor):
+        """
+        Returns a copy of the batch with the coordinates multiplied by the factor, e.g., for
+        predictions that were made on a scaled version of the frame.
+
+        :param factor: the factor to apply to the coordinates
+        :type factor: float
+        :return: the new batch
+        :rtype: PredictionsBatch
+        """
+        coords = np.rint(self.coords * factor).astype(np.int32)
+        return PredictionsBatch(coords, self.scores, self.labels)
+
+
+def _to_int_coord(s):
+    """
+    Turns the string into an integer coordinate, parsing it as float
+    only if it is not an integer string.
+
+    :param s: the string to convert
+    :type s: str
+    :return: the coordinate
+    :rtype: int
+    """
+    try:
+        return int(s)
+    except ValueError:
+        return int(float(s))
+
+
 def _load_roiscsv(fp):
     """
     Loads the specified ROIs CSV file.
@@ -51,36 +147,115 @@ def _load_roiscsv(fp):
     """
     result = []
 
-    reader = csv.DictReader(fp)
-    for i, row in enumerate(reader):
+    reader = csv.reader(fp)
+    header = next(reader, None)
+    if header is None:
+        return result
+
+    # determine column indices only once
+    cols = {name: i for i, name in enumerate(header)}
+    score_i = cols.get("score")
+    label_i = cols.get("label_str")
+    xywh_i = None
+    if "x" in cols:
+        xywh_i = (cols["x"], cols["y"], cols["w"], cols["h"])
+    minmax_i = None
+    if "x0" in cols:
+        minmax_i = (cols["x0"], cols["y0"], cols["x1"], cols["y1"])
+
+    for row in reader:
+        # skip empty rows, like csv.DictReader does
+        if len(row) == 0:
+            continue
+
         # score
         score = 1.0
-        if "score" in row:
-            score = float(row["score"])
+        if score_i is not None:
+            score = float(row[score_i])
 
         # label
         label = ""
-        if "label_str" in row:
-            label = row["label_str"]
+        if label_i is not None:
+            label = row[label_i]
 
         # coordinates
         coords = None
-        if "x0" in row:
-            coords = (int(float(row["x0"])), int(float(row["y0"])), int(float(row["x1"])), int(float(row["y1"])))
-        if "x" in row:
-            x = int(float(row["x"]))
-            y = int(float(row["y"]))
-            coords = (x, y, x + int(float(row["w"])) - 1, y + int(float(row["h"])) - 1)
-
-        p = Prediction(i, label, score, coords=coords)
+        if xywh_i is not None:
+            x = _to_int_coord(row[xywh_i[0]])
+            y = _to_int_coord(row[xywh_i[1]])
+            coords = (x, y, x + _to_int_coord(row[xywh_i[2]]) - 1, y + _to_int_coord(row[xywh_i[3]]) - 1)
+        elif minmax_i is not None:
+            coords = (_to_int_coord(row[minmax_i[0]]), _to_int_coord(row[minmax_i[1]]),
+                      _to_int_coord(row[minmax_i[2]]), _to_int_coord(row[minmax_i[3]]))
+
+        p = Prediction(len(result), label, score, coords=coords)
         result.append(p)
 
     return result
 
 
-def load_roiscsv(analysis_file):
+def _cache_enabled():
     """
-    Loads the specified ROIs CSV file.
+    Checks whether the cache for parsed analysis files is enabled, i.e., CACHE_SIZE is
+    larger than 0 and the VFS_PREDICTION_CACHE environment variable is not set to 0.
+
+    :return: True if enabled
+    :rtype: bool
+    """
+    return (CACHE_SIZE > 0) and (os.environ.get(CACHE_ENV, "1").strip() != "0")
+
+
+def _load_cached(analysis_file, reader, use_cache):
+    """
+    Loads the predictions from the specified file, using the cache if enabled.
+    Cache entries are stored per path, along with the inode, size, modification and
+    change time (ns) of the file. As the change time cannot be set via os.utime,
+    re-written files get parsed again even if their size and modification time got restored.
+    Only immutable tuples get cached, new Prediction objects are returned on every call.
+
+    :param analysis_file: the file to load
+    :type analysis_file: str
+    :param reader: the function for reading the file, returns a list of predictions
+    :param use_cache: whether to use the cache
+    :type use_cache: bool
+    :return: the list of predictions
+    :rtype: list
+    """
+    if not use_cache or not _cache_enabled():
+        return reader(analysis_file)
+
+    st = os.stat(analysis_file)
+    sig = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    with _cache_lock:
+        entry = _cache.get(analysis_file)
+        if (entry is not None) and (entry[0] == sig):
+            _cache.move_to_end(analysis_file)
+        else:
+            entry = None
+
+    if entry is None:
+        preds = tuple((p.index, p.label, p.score, p.data, p.coords) for p in reader(analysis_file))
+        entry = (sig, preds)
+        with _cache_lock:
+            _cache[analysis_file] = entry
+            _cache.move_to_end(analysis_file)
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+
+    return [Prediction(*p) for p in entry[1]]
+
+
+def clear_cache():
+    """
+    Removes all entries from the cache of parsed analysis files.
+    """
+    with _cache_lock:
+        _cache.clear()
+
+
+def _read_roiscsv(analysis_file):
+    """
+    Reads the specified ROIs CSV file.
 
     :param analysis_file: the ROIs CSV file to load
     :type analysis_file: str
@@ -91,6 +266,21 @@ def load_roiscsv(analysis_file):
         return _load_roiscsv(fp)
 
 
+def load_roiscsv(analysis_file, use_cache=True):
+    """
+    Loads the specified ROIs CSV file. The parsed content gets cached (unless disabled),
+    see _load_cached.
+
+    :param analysis_file: the ROIs CSV file to load
+    :type analysis_file: str
+    :param use_cache: whether to use the cache, should be disabled for files that only get read once
+    :type use_cache: bool
+    :return: the list of predictions
+    :rtype: list
+    """
+    return _load_cached(analysis_file, _read_roiscsv, use_cache)
+
+
 def load_roiscsv_from_str(analysis_str):
     """
     Loads data from the specified ROIs CSV string.
@@ -110,30 +300,78 @@ def _opex_to_predictions(preds):
     Turns the OPEX data structure into predictions.
 
     :param preds: the OPEX data to convert
-    :type preds: ObjectPredictions
+    :type preds: opex.ObjectPredictions
     :return: the list of predictions
     :rtype: list
     """
     result = []
 
     for i, pred in enumerate(preds.objects):
-        coords = (pred.bbox.left, pred.bbox.top, pred.bbox.bottom, pred.bbox.right)
+        coords = (pred.bbox.left, pred.bbox.top, pred.bbox.right, pred.bbox.bottom)
         p = Prediction(i, pred.label, pred.score, coords=coords)
         result.append(p)
 
     return result
 
 
-def load_opexjson(analysis_file):
+def _json_loads(analysis_str):
     """
-    Loads the specified OPEX JSON file.
+    Parses the JSON string, using orjson if available. Falls back on the standard
+    json module if orjson rejects the string, e.g., due to NaN/Infinity values
+    (as written by Python's json.dumps by default).
+
+    :param analysis_str: the JSON string to parse
+    :type analysis_str: str or bytes
+    :return: the parsed data
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(analysis_str)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(analysis_str)
+
+
+def _parse_opexjson(analysis_str):
+    """
+    Parses the OPEX JSON string, using orjson if available (see _json_loads).
+
+    :param analysis_str: the OPEX JSON string to parse
+    :type analysis_str: str or bytes
+    :return: the list of predictions
+    :rtype: list
+    """
+    # imported here, to avoid loading opex when only using ROI CSV files
+    from opex import ObjectPredictions
+    return _opex_to_predictions(ObjectPredictions.from_raw_json(_json_loads(analysis_str)))
+
+
+def _read_opexjson(analysis_file):
+    """
+    Reads the specified OPEX JSON file.
+
+    :param analysis_file: the OPEX JSON file to load
+    :type analysis_file: str
+    :return: the list of predictions
+    :rtype: list
+    """
+    with open(analysis_file, "rb") as fp:
+        return _parse_opexjson(fp.read())
+
+
+def load_opexjson(analysis_file, use_cache=True):
+    """
+    Loads the specified OPEX JSON file. The parsed content gets cached (unless disabled),
+    see _load_cached.
 
     :param analysis_file: the OPEX JSON file to load
     :type analysis_file: str
+    :param use_cache: whether to use the cache, should be disabled for files that only get read once
+    :type use_cache: bool
     :return: the list of predictions
     :rtype: list
     """
-    return _opex_to_predictions(ObjectPredictions.load_json_from_file(analysis_file))
+    return _load_cached(analysis_file, _read_opexjson, use_cache)
 
 
 def load_opexjson_from_str(analysis_str):
@@ -145,21 +383,43 @@ def load_opexjson_from_str(analysis_str):
     :return: the list of predictions
     :rtype: list
     """
-    if isinstance(analysis_str, bytes):
-        analysis_str = analysis_str.decode()
-    return _opex_to_predictions(ObjectPredictions.from_json_string(analysis_str))
+    return _parse_opexjson(analysis_str)
+
+
+def _bbox_dict(x0, y0, x1, y1):
+    """
+    Turns the bounding box into a dictionary for the metadata.
+
+    :param x0: the left coordinate
+    :type x0: int
+    :param y0: the top coordinate
+    :type y0: int
+    :param x1: the right coordinate
+    :type x1: int
+    :param y1: the bottom coordinate
+    :type y1: int
+    :return: the dictionary
+    :rtype: dict
+    """
+    return {
+        "x0": x0,
+        "y0": y0,
+        "x1": x1,
+        "y1": y1,
+    }
 
 
-def crop_frame(frame, predictions, metadata, margin=0, min_width=2, min_height=2, verbose=False):
+def crop_frame(frame, predictions, metadata, margin=0, min_width=2, min_height=2, verbose=False,
+               collect_metadata=True, out=None):
     """
     Crops the frame according to the content of the predictions.
     If even only a single predictions has no predictions, then no cropping occurs.
 
     :param frame: the frame to crop
     :type frame: ndarray
-    :param predictions: the list of Prediction objects, can be None
-    :type predictions: list
-    :param metadata: for attaching metadata
+    :param predictions: the list of Prediction objects or a PredictionsBatch, can be None
+    :type predictions: list or PredictionsBatch
+    :param metadata: for attaching metadata, can be None if not collecting metadata
     :type metadata: dict
     :param margin: the margin around the cropped content
     :type margin: int
@@ -169,15 +429,22 @@ def crop_frame(frame, predictions, metadata, margin=0, min_width=2, min_height=2
     :type min_height: int
     :param verbose: whether to print logging information
     :type verbose: bool
-    :return: the (potentially) cropped frame
+    :param collect_metadata: whether to attach information about the frame and the cropping to the metadata
+    :type collect_metadata: bool
+    :param out: the optional, reusable array to copy the cropped content into; only used if its shape
+                matches the cropped region
+    :type out: ndarray
+    :return: the (potentially) cropped frame; if no suitable out array was supplied, the cropped frame is a view
+             on the input frame rather than a copy
     :rtype: ndarray
     """
 
     height, width = frame.shape[:2]
-    metadata["frame"] = {
-        "width": width,
-        "height": height,
-    }
+    if collect_metadata:
+        metadata["frame"] = {
+            "width": width,
+            "height": height,
+        }
 
     if predictions is None:
         return frame
@@ -185,47 +452,42 @@ def crop_frame(frame, predictions, metadata, margin=0, min_width=2, min_height=2
     if verbose:
         log("Frame width x height: %d x %d" % (width, height))
 
-    x0 = width
-    y0 = height
-    x1 = 0
-    y1 = 0
+    # no predictions, cannot crop
+    if len(predictions) == 0:
+        if verbose:
+            log("Cannot crop")
+        if collect_metadata:
+            metadata["cropped"] = False
+        return frame
 
-    for p in predictions:
-        if p.coords is None:
-            continue
-        cx0, cy0, cx1, cy1 = p.coords
-        x0 = min(x0, cx0)
-        y0 = min(y0, cy0)
-        x1 = max(x1, cx1)
-        y1 = max(y1, cy1)
+    if not isinstance(predictions, PredictionsBatch):
+        predictions = PredictionsBatch.from_predictions(predictions)
 
     # no crop window found, cannot crop
-    if (x0 == width) or (y0 == height):
+    coords = predictions.coords
+    if len(coords) == 0:
         if verbose:
             log("Cannot crop")
-        metadata["cropped"] = False
+        if collect_metadata:
+            metadata["cropped"] = False
         return frame
 
-    metadata["cropped"] = True
-    metadata["minimal_bbox"] = {
-        "x0": x0,
-        "y0": y0,
-        "x1": x1,
-        "y1": y1,
-    }
+    cx0, cy0 = coords[:, :2].min(axis=0)
+    cx1, cy1 = coords[:, 2:].max(axis=0)
+    x0 = min(width, int(cx0))
+    y0 = min(height, int(cy0))
+    x1 = max(0, int(cx1))
+    y1 = max(0, int(cy1))
+    minimal_bbox = (x0, y0, x1, y1)
 
     # add margin?
+    margin_bbox = None
     if margin > 0:
         x0 = max(0, x0 - margin)
         y0 = max(0, y0 - margin)
         x1 = min(width - 1, x1 + margin)
         y1 = min(height - 1, y1 + margin)
-        metadata["margin_bbox"] = {
-            "x0": x0,
-            "y0": y0,
-            "x1": x1,
-            "y1": y1,
-        }
+        margin_bbox = (x0, y0, x1, y1)
 
     # correct width?
     curr_width = x1 - x0 + 1
@@ -251,30 +513,68 @@ def crop_frame(frame, predictions, metadata, margin=0, min_width=2, min_height=2
         if verbose:
             log("Corrected: y0=%d, y1=%d" % (y0, y1))
 
-    metadata["crop_bbox"] = {
-        "x0": x0,
-        "y0": y0,
-        "x1": x1,
-        "y1": y1,
-    }
+    if collect_metadata:
+        metadata["cropped"] = True
+        metadata["minimal_bbox"] = _bbox_dict(*minimal_bbox)
+        if margin_bbox is not None:
+            metadata["margin_bbox"] = _bbox_dict(*margin_bbox)
+        metadata["crop_bbox"] = _bbox_dict(x0, y0, x1, y1)
 
     if verbose:
         log("Cropping: x0=%d, y0=%d, x1=%d, y1=%d" % (x0, y0, x1, y1))
-    return frame[y0:y1, x0:x1]
+    cropped = frame[y0:y1, x0:x1]
+    if (out is not None) and (out.shape == cropped.shape):
+        np.copyto(out, cropped)
+        return out
+    return cropped
+
+
+def _check_batch(batch, min_score, required_labels, excluded_labels, verbose):
+    """
+    Checks the labels of the batch via set operations on the labels that have the minimum score.
+
+    :param batch: the predictions to check
+    :type batch: PredictionsBatch
+    :param min_score: the minimum score the predictions must have to be considered
+    :type min_score: float
+    :param required_labels: the labels that must have the specified min_score, ignored if None
+    :type required_labels: set or frozenset or None
+    :param excluded_labels: the labels that must not have the specified min_score, ignored if None
+    :type excluded_labels: set or frozenset or None
+    :param verbose: whether to print some logging information
+    :type verbose: bool
+    :return: whether to include the frame or not
+    :rtype: bool
+    """
+    labels = batch.labels[batch.scores >= min_score]
+
+    if excluded_labels is not None:
+        hits = excluded_labels.intersection(labels)
+        if len(hits) > 0:
+            if verbose:
+                log("Excluded label(s) %s have score >= min score: %f" % (", ".join(sorted(hits)), min_score))
+            return False
+
+    if required_labels is None:
+        return True
+    hits = required_labels.intersection(labels)
+    if verbose and (len(hits) > 0):
+        log("Required label(s) %s have score >= min score: %f" % (", ".join(sorted(hits)), min_score))
+    return len(hits) > 0
 
 
 def check_predictions(predictions, min_score, required_labels, excluded_labels, verbose):
     """
     Checks whether the frame processed by the image analysis process can be included in the output.
 
-    :param predictions: the list of Prediction objects to check
-    :type predictions: list
+    :param predictions: the list of Prediction objects or a PredictionsBatch to check
+    :type predictions: list or PredictionsBatch
     :param min_score: the minimum score the predictions must have to be considered
     :type min_score: float
     :param required_labels: the list of labels that must have the specified min_score, ignored if None
-    :type required_labels: list or None
+    :type required_labels: list or set or None
     :param excluded_labels: the list of labels that must not have the specified min_score, ignored if None
-    :type excluded_labels: list or None
+    :type excluded_labels: list or set or None
     :param verbose: whether to print some logging information
     :type verbose: bool
     :return: whether to include the frame or not
@@ -284,21 +584,40 @@ def check_predictions(predictions, min_score, required_labels, excluded_labels,
     if (required_labels is None) and (excluded_labels is None):
         return True
 
-    # check predictions
-    result = None
-    for p in predictions:
-        if (required_labels is not None) and (len(required_labels) > 0):
-            if (p.label in required_labels) and (p.score >= min_score):
+    # sets allow for constant time lookups
+    if (required_labels is not None) and not isinstance(required_labels, (set, frozenset)):
+        required_labels = frozenset(required_labels)
+    if (excluded_labels is not None) and not isinstance(excluded_labels, (set, frozenset)):
+        excluded_labels = frozenset(excluded_labels)
+
+    has_required = (required_labels is not None) and (len(required_labels) > 0)
+    has_excluded = (excluded_labels is not None) and (len(excluded_labels) > 0)
+    if isinstance(predictions, PredictionsBatch):
+        return _check_batch(predictions, min_score, required_labels if has_required else None,
+                            excluded_labels if has_excluded else None, verbose)
+    if not has_excluded:
+        # required labels present? -> can stop at the first hit
+        if not has_required:
+            return True
+        for p in predictions:
+            if (p.score >= min_score) and (p.label in required_labels):
                 if verbose:
                     log("Required label '%s' has score of %f (>= min score: %f)" % (p.label, p.score, min_score))
-                result = True
-
-        if (excluded_labels is not None) and (len(excluded_labels) > 0):
-            if (p.label in excluded_labels) and (p.score >= min_score):
-                if verbose:
-                    log("Excluded label '%s' has score of %f (>= min score: %f)" % (p.label, p.score, min_score))
-                result = False
-    if result is None:
-        result = False
+                return True
+        return False
 
-    return result
+    # single pass: stop at the first excluded label, remember whether a required label was encountered
+    found = not has_required
+    for p in predictions:
+        if p.score < min_score:
+            continue
+        if p.label in excluded_labels:
+            if verbose:
+                log("Excluded label '%s' has score of %f (>= min score: %f)" % (p.label, p.score, min_score))
+            return False
+        if (not found) and (p.label in required_labels):
+            if verbose:
+                log("Required label '%s' has score of %f (>= min score: %f)" % (p.label, p.score, min_score))
+            found = True
+
+    return found
@@ -1,16 +1,19 @@
 import argparse
 import cv2
+import io
+import numpy as np
 import os
 import traceback
-from datetime import datetime
-from time import sleep
-from yaml import safe_dump
-
-from vfs.common import INPUT_IMAGE_DIR, INPUT_VIDEO, INPUT_WEBCAM, INPUT_TYPES, ANALYSIS_ROISCSV, ANALYSIS_OPEXJSON, \
-    ANALYSIS_TYPES, OUTPUT_JPG, OUTPUT_MJPG, OUTPUT_TYPES, ANALYSIS_FORMAT, list_images
-from vfs.predictions import crop_frame, check_predictions, load_roiscsv, load_opexjson
+from time import sleep, monotonic
+
+from vfs.common import INPUT_TYPES, INPUT_VIDEO, HW_DECODE_TYPES, HW_DECODE_NONE, DECODERS, DECODER_OPENCV, \
+    ANALYSIS_ROISCSV, ANALYSIS_OPEXJSON, ANALYSIS_TYPES, OUTPUT_TYPES, ANALYSIS_STEM_FORMAT, ANALYSIS_IMAGE_TYPES, \
+    ANALYSIS_IMAGE_NPY, JPEG_QUALITY, FrameWriterPool, ImagePrefetcher, BackgroundReader, open_input, seek_video, \
+    resize_frame, open_output, FrameWriter, METADATA_FORMATS, METADATA_YAML, copy_file, check_same_filesystem, \
+    image_write_params, write_image, write_file
+from vfs.predictions import crop_frame, check_predictions, load_roiscsv, load_opexjson, PredictionsBatch
 from vfs.logging import log
-from vfs.prune import detect_change
+from vfs.prune import enable_opencl, same_file, prepare_image, detect_change_prepared, AdaptiveSkipper
 
 
 def cleanup_file(path):
@@ -20,8 +23,66 @@ def cleanup_file(path):
     :param path: the file to remove
     :type path: str
     """
-    if os.path.exists(path):
+    try:
         os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class OutputWatcher(object):
+    """
+    Waits for files getting written to or moved into the analysis output directory,
+    using inotify (Linux only, requires the inotify_simple library).
+    """
+
+    def __init__(self, analysis_output):
+        """
+        Starts watching the directory.
+
+        :param analysis_output: the output directory of the image analysis process
+        :type analysis_output: str
+        """
+        from inotify_simple import INotify, flags
+        self.inotify = INotify()
+        self.inotify.add_watch(analysis_output, flags.CLOSE_WRITE | flags.MOVED_TO)
+
+    def wait(self, timeout):
+        """
+        Waits for files to get written/moved into the directory.
+
+        :param timeout: the maximum number of seconds to wait
+        :type timeout: float
+        :return: whether any files were written/moved
+        :rtype: bool
+        """
+        return len(self.inotify.read(timeout=max(0, int(timeout * 1000)))) > 0
+
+    def close(self):
+        """
+        Stops watching the directory.
+        """
+        self.inotify.close()
+
+
+def create_watcher(analysis_output, verbose=False):
+    """
+    Creates an OutputWatcher for the directory, if inotify is available.
+
+    :param analysis_output: the output directory of the image analysis process
+    :type analysis_output: str
+    :param verbose: whether to be verbose
+    :type verbose: bool
+    :return: the watcher, None if inotify not available
+    :rtype: OutputWatcher
+    """
+    try:
+        result = OutputWatcher(analysis_output)
+        if verbose:
+            log("Using inotify for: %s" % analysis_output)
+        return result
+    except Exception as e:
+        log("Failed to set up inotify, falling back to polling: %s" % str(e))
+        return None
 
 
 def load_output(analysis_file, analysis_type, metadata):
@@ -38,9 +99,9 @@ def load_output(analysis_file, analysis_type, metadata):
     :rtype: list
     """
     if analysis_type == ANALYSIS_ROISCSV:
-        result = load_roiscsv(analysis_file)
+        result = load_roiscsv(analysis_file, use_cache=False)
     elif analysis_type == ANALYSIS_OPEXJSON:
-        result = load_opexjson(analysis_file)
+        result = load_opexjson(analysis_file, use_cache=False)
     else:
         raise Exception("Unhandled analysis type: %s" % analysis_type)
 
@@ -49,11 +110,84 @@ def load_output(analysis_file, analysis_type, metadata):
     return result
 
 
+class AnalysisFiles(object):
+    """
+    The templates for the files exchanged with the image analysis process, which
+    only need to be filled in with the frame number.
+    """
+
+    def __init__(self, analysis_input, analysis_output, analysis_tmp, analysis_type, analysis_image_type):
+        """
+        Initializes the templates.
+
+        :param analysis_input: the input directory of the image analysis process
+        :type analysis_input: str
+        :param analysis_output: the output directory of the image analysis process
+        :type analysis_output: str
+        :param analysis_tmp: the tmp directory to write the image to before moving it into the image analysis input dir
+        :type analysis_tmp: str or None
+        :param analysis_type: the type of output the analysis is generated, see ANALYSIS_TYPES
+        :type analysis_type: str
+        :param analysis_image_type: the type of image to present the frame as, see ANALYSIS_IMAGE_TYPES
+        :type analysis_image_type: str
+        """
+        ext = "." + analysis_image_type
+        self.img_in = self._template(analysis_input, ext)
+        self.img_tmp = None if (analysis_tmp is None) else self._template(analysis_tmp, ext)
+        self.img_out = self._template(analysis_output, ext)
+        if analysis_type == ANALYSIS_ROISCSV:
+            self.out_files = [self._template(analysis_output, "-rois.csv"), self._template(analysis_output, ".csv")]
+        elif analysis_type == ANALYSIS_OPEXJSON:
+            self.out_files = [self._template(analysis_output, ".json")]
+        else:
+            raise Exception("Unhandled analysis type: %s" % analysis_type)
+
+    def _template(self, directory, suffix):
+        """
+        Generates the template for the directory and file suffix.
+
+        :param directory: the directory of the file
+        :type directory: str
+        :param suffix: the suffix to append to the file name (stem)
+        :type suffix: str
+        :return: the template
+        :rtype: str
+        """
+        return os.path.join(directory.replace("%", "%%"), ANALYSIS_STEM_FORMAT + suffix.replace("%", "%%"))
+
+
+def write_analysis_image(path, frame, analysis_image_type, jpeg_quality, direct=False):
+    """
+    Writes the frame to present to the image analysis process.
+
+    :param path: the file to write to
+    :type path: str
+    :param frame: the frame to write
+    :type frame: ndarray
+    :param analysis_image_type: the type of image to write, see ANALYSIS_IMAGE_TYPES
+    :type analysis_image_type: str
+    :param jpeg_quality: the quality (0-100) to use when writing JPEG images
+    :type jpeg_quality: int
+    :param direct: whether the file gets written directly into the analysis input dir rather than a tmp dir,
+                   in which case it only becomes visible once completely written (where supported)
+    :type direct: bool
+    """
+    if analysis_image_type == ANALYSIS_IMAGE_NPY:
+        # the raw BGR array, no encoding involved
+        buf = io.BytesIO()
+        np.save(buf, frame)
+        write_file(path, buf.getbuffer())
+    elif direct:
+        write_image(path, frame, image_write_params(path, jpeg_quality=jpeg_quality))
+    else:
+        cv2.imwrite(path, frame, image_write_params(path, jpeg_quality=jpeg_quality))
+
+
 def process_image(frame, frameno, analysis_input, analysis_output, analysis_tmp,
-                  analysis_timeout, analysis_type, analysis_keep_files,
+                  analysis_timeout, analysis_type, analysis_image_type, analysis_keep_files, jpeg_quality,
                   min_score, required_labels, excluded_labels, poll_interval,
                   crop_to_content, crop_margin, crop_min_width, crop_min_height,
-                  verbose):
+                  verbose, watcher=None, templates=None, analysis_max_dim=0):
     """
     Pushes a frame through the image analysis framework and returns whether to keep it or not.
 
@@ -71,14 +205,18 @@ def process_image(frame, frameno, analysis_input, analysis_output, analysis_tmp,
     :type analysis_timeout: float
     :param analysis_type: the type of output the analysis is generated, see ANALYSIS_TYPES
     :type analysis_type: str
+    :param analysis_image_type: the type of image to present the frame as, see ANALYSIS_IMAGE_TYPES
+    :type analysis_image_type: str
     :param analysis_keep_files: whether to keep the analysis files rather than deleting them
     :type analysis_keep_files: bool
+    :param jpeg_quality: the quality (0-100) to use when presenting the frame as JPEG
+    :type jpeg_quality: int
     :param min_score: the minimum score that the predictions have to have
     :type min_score: float
     :param required_labels: the list of labels that must have the specified min_score, ignored if None or empty
-    :type required_labels: list or None
+    :type required_labels: list or set or None
     :param excluded_labels: the list of labels that must not have the specified min_score, ignored if None or empty
-    :type excluded_labels: list or None
+    :type excluded_labels: list or set or None
     :param poll_interval: the interval in seconds for the file polling
     :type poll_interval: float
     :param crop_to_content: whether to crop the frame to the content (eg bounding boxes)
@@ -91,48 +229,53 @@ def process_image(frame, frameno, analysis_input, analysis_output, analysis_tmp,
     :type crop_min_height: int
     :param verbose: whether to print some logging information
     :type verbose: bool
+    :param watcher: for waiting on the analysis output rather than sleeping for poll_interval, polls if None
+    :type watcher: OutputWatcher
+    :param templates: the file name templates to use, generated on the fly if None
+    :type templates: AnalysisFiles
+    :param analysis_max_dim: the maximum width/height of the image presented to the analysis, larger frames get scaled down; no scaling if <= 0
+    :type analysis_max_dim: int
     :return: tuple (whether to keep the frame or skip it, potentially cropped frame)
     :rtype: tuple
     """
-    if analysis_tmp is not None:
-        img_tmp_file = os.path.join(analysis_tmp, (ANALYSIS_FORMAT % frameno).replace(".EXT", ".jpg"))
-        img_in_file = os.path.join(analysis_input, (ANALYSIS_FORMAT % frameno).replace(".EXT", ".jpg"))
+    if templates is None:
+        templates = AnalysisFiles(analysis_input, analysis_output, analysis_tmp, analysis_type, analysis_image_type)
+    img_in_file = templates.img_in % frameno
+    frame_analysis, frame_scale = resize_frame(frame, analysis_max_dim)
+    if templates.img_tmp is not None:
+        img_tmp_file = templates.img_tmp % frameno
         if verbose:
             log("Writing image: %s" % img_tmp_file)
-        cv2.imwrite(img_tmp_file, frame)
+        write_analysis_image(img_tmp_file, frame_analysis, analysis_image_type, jpeg_quality)
         if verbose:
             log("Renaming image to: %s" % img_in_file)
         os.rename(img_tmp_file, img_in_file)
     else:
-        img_in_file = os.path.join(analysis_input, (ANALYSIS_FORMAT % frameno).replace(".EXT", ".jpg"))
         if verbose:
             log("Writing image: %s" % img_in_file)
-        cv2.imwrite(img_in_file, frame)
-    img_out_file = os.path.join(analysis_output, (ANALYSIS_FORMAT % frameno).replace(".EXT", ".jpg"))
-
-    if analysis_type == ANALYSIS_ROISCSV:
-        name1 = (ANALYSIS_FORMAT % frameno).replace(".EXT", "-rois.csv")
-        name2 = (ANALYSIS_FORMAT % frameno).replace(".EXT", ".csv")
-        out_files = [os.path.join(analysis_output, name1), os.path.join(analysis_output, name2)]
-    elif analysis_type == ANALYSIS_OPEXJSON:
-        name1 = (ANALYSIS_FORMAT % frameno).replace(".EXT", ".json")
-        out_files = [os.path.join(analysis_output, name1)]
-    else:
-        raise Exception("Unhandled analysis type: %s" % analysis_type)
+        write_analysis_image(img_in_file, frame_analysis, analysis_image_type, jpeg_quality, direct=True)
+    img_out_file = templates.img_out % frameno
+    out_files = [t % frameno for t in templates.out_files]
 
     metadata = dict()
 
     # pass through image analysis
-    end = datetime.now().microsecond + analysis_timeout * 10e6
-    while datetime.now().microsecond < end:
+    end = monotonic() + analysis_timeout
+    while monotonic() < end:
         for out_file in out_files:
             if os.path.exists(out_file):
                 if verbose:
                     log("Checking analysis output: %s" % out_file)
                 predictions = load_output(out_file, analysis_type, metadata)
+                if crop_to_content and (len(predictions) > 0):
+                    # labels get checked and the crop region determined with the same column-oriented batch
+                    predictions = PredictionsBatch.from_predictions(predictions)
+                    if frame_scale != 1.0:
+                        # predictions were made on the scaled frame
+                        predictions = predictions.scaled(1.0 / frame_scale)
                 result = check_predictions(predictions, min_score, required_labels, excluded_labels, verbose)
                 if not analysis_keep_files:
-                    os.remove(out_file)
+                    cleanup_file(out_file)
                 if verbose:
                     log("Can be included: %s" % str(result))
                 if result:
@@ -143,7 +286,10 @@ def process_image(frame, frameno, analysis_input, analysis_output, analysis_tmp,
                 cleanup_file(img_in_file)
                 cleanup_file(img_out_file)
                 return result, frame, metadata
-        sleep(poll_interval)
+        if watcher is not None:
+            watcher.wait(end - monotonic())
+        else:
+            sleep(poll_interval)
 
     # clean up if necessary
     cleanup_file(img_in_file)
@@ -154,15 +300,19 @@ def process_image(frame, frameno, analysis_input, analysis_output, analysis_tmp,
 
 def process(input, input_type, nth_frame, max_frames,
             analysis_input, analysis_output, analysis_tmp,
-            analysis_timeout, analysis_type, analysis_keep_files, from_frame, to_frame,
+            analysis_timeout, analysis_type, analysis_image_type, analysis_keep_files, from_frame, to_frame,
             min_score, required_labels, excluded_labels, poll_interval,
-            output, output_type, output_format, output_tmp, output_fps, output_metadata,
+            output, output_type, output_format, output_tmp, output_fps, output_metadata, jpeg_quality,
+            jpeg_optimize, num_writers,
             crop_to_content, crop_margin, crop_min_width, crop_min_height,
-            verbose, progress, keep_original, prune, bw_threshold, change_threshold):
+            verbose, progress, keep_original, prune, bw_threshold, change_threshold,
+            prune_scale, hw_decode, adaptive_skip, skip_min, skip_max, skip_lambda,
+            opencl, decoder, prefetch, use_inotify, metadata_format, analysis_max_dim, analysis_jpeg_quality,
+            capture_buffer, scan_threads):
     """
     Processes the input video or webcam feed.
     
-    :param input: the input dir, video or webcam ID
+    :param input: the input dir, video, webcam ID or GStreamer pipeline (gstreamer decoder)
     :type input: str
     :param input_type: the type of input, INPUT_TYPES
     :type input_type: str
@@ -180,6 +330,8 @@ def process(input, input_type, nth_frame, max_frames,
     :type analysis_timeout: float
     :param analysis_type: the type of output the analysis is generated, see ANALYSIS_TYPES
     :type analysis_type: str
+    :param analysis_image_type: the type of image to present the frames as, see ANALYSIS_IMAGE_TYPES
+    :type analysis_image_type: str
     :param analysis_keep_files: whether to keep the analysis files rather than deleting them
     :type analysis_keep_files: bool
     :param from_frame: the starting frame (incl), ignored if <=0
@@ -189,9 +341,9 @@ def process(input, input_type, nth_frame, max_frames,
     :param min_score: the minimum score that the predictions have to have
     :type min_score: float
     :param required_labels: the list of labels that must have the specified min_score, ignored if None or empty
-    :type required_labels: list
+    :type required_labels: list or set
     :param excluded_labels: the list of labels that must not have the specified min_score, ignored if None or empty
-    :type excluded_labels: list
+    :type excluded_labels: list or set
     :param poll_interval: the interval in seconds for the file polling
     :type poll_interval: float
     :param output: the output video oor directory for output images
@@ -204,8 +356,14 @@ def process(input, input_type, nth_frame, max_frames,
     :type output_tmp: str
     :param output_fps: the frames-per-second to use when generating an output video
     :type output_fps: int
-    :param output_metadata: whether to output metadata as YAML file alongside JPG frames
+    :param output_metadata: whether to output metadata as YAML/JSON file alongside JPG frames
     :type output_metadata: bool
+    :param jpeg_quality: the quality (0-100) to use for encoding JPEG images
+    :type jpeg_quality: int
+    :param jpeg_optimize: whether to use optimized Huffman tables for the output JPEG images
+    :type jpeg_optimize: bool
+    :param num_writers: the number of threads to use for writing output images, no threads if <= 1
+    :type num_writers: int
     :param crop_to_content: whether to crop the frame to the content (eg bounding boxes)
     :type crop_to_content: bool
     :param crop_margin: the margin to use around the cropped content
@@ -222,29 +380,45 @@ def process(input, input_type, nth_frame, max_frames,
     :type keep_original: bool
     :param prune: whether to discard images if they isn't enough change between them
     :type prune: bool
-    :param bw_threshold: the threshold (0-255) for the black/white conversion (requires prune)
+    :param bw_threshold: the threshold (0-255) for the black/white conversion (requires prune or adaptive_skip)
     :type bw_threshold: int
     :param change_threshold: the threshold (0.0-1.0) for the change detection (requires prune)
     :type change_threshold: float
+    :param prune_scale: the scale factor to apply to the frames before the change detection (requires prune or adaptive_skip)
+    :type prune_scale: float
+    :param hw_decode: the type of hardware acceleration to use for decoding videos (opencv decoder), HW_DECODE_TYPES
+    :type hw_decode: str
+    :param adaptive_skip: whether to select the frames based on the accumulated change rather than every nth frame
+    :type adaptive_skip: bool
+    :param skip_min: the minimum number of frames to skip after a selected frame (requires adaptive_skip)
+    :type skip_min: int
+    :param skip_max: the maximum number of frames to skip after a selected frame, ignored if <= 0 (requires adaptive_skip)
+    :type skip_max: int
+    :param skip_lambda: the accumulated change ratio at which to select the next frame (requires adaptive_skip)
+    :type skip_lambda: float
+    :param opencl: whether to use OpenCL (if available) for the change detection (prune/adaptive_skip)
+    :type opencl: bool
+    :param decoder: the decoder to use for videos, DECODERS
+    :type decoder: str
+    :param prefetch: the number of images/video frames to read ahead in background threads, off if <= 0, ignored for webcams
+    :type prefetch: int
+    :param use_inotify: whether to use inotify for detecting the analysis output rather than polling (Linux only)
+    :type use_inotify: bool
+    :param metadata_format: the format for the metadata files, see METADATA_FORMATS
+    :type metadata_format: str
+    :param analysis_max_dim: the maximum width/height of the images presented to the analysis, larger frames get scaled down; no scaling if <= 0
+    :type analysis_max_dim: int
+    :param analysis_jpeg_quality: the quality (0-100) for the JPEG images presented to the analysis, uses jpeg_quality if < 0
+    :type analysis_jpeg_quality: int
+    :param capture_buffer: the number of frames to buffer when capturing from a webcam, uses the backend's default if <= 0
+    :type capture_buffer: int
+    :param scan_threads: the number of threads to use for scanning the image dir (eg on network file systems)
+    :type scan_threads: int
     """
 
     # open input
-    if input_type not in INPUT_TYPES:
-        raise Exception("Unknown input type: %s" % input_type)
-    cap = None
-    files = None
-    if input_type == INPUT_IMAGE_DIR:
-        files = list_images(input, verbose=verbose)
-    elif input_type == INPUT_VIDEO:
-        if verbose:
-            log("Opening input video: %s" % input)
-        cap = cv2.VideoCapture(input)
-    elif input_type == INPUT_WEBCAM:
-        if verbose:
-            log("Opening webcam: %s" % input)
-        cap = cv2.VideoCapture(int(input))
-    else:
-        raise Exception("Unhandled input type: %s" % input_type)
+    cap, files = open_input(input, input_type, verbose=verbose, hw_decode=hw_decode, decoder=decoder,
+                            capture_buffer=capture_buffer, scan_threads=scan_threads)
 
     # frames
     if (from_frame > 0) and (to_frame > 0):
@@ -254,42 +428,101 @@ def process(input, input_type, nth_frame, max_frames,
     # analysis
     if analysis_type not in ANALYSIS_TYPES:
         raise Exception("Unknown analysis type: %s" % analysis_type)
+    if analysis_image_type not in ANALYSIS_IMAGE_TYPES:
+        raise Exception("Unknown analysis image type: %s" % analysis_image_type)
     if (analysis_input is not None) and (analysis_output is None):
         raise Exception("No analysis output dir specified, but analysis input dir provided!")
     if (analysis_input is None) and (analysis_output is not None):
         raise Exception("No analysis input dir specified, but analysis output dir provided!")
+    if (analysis_input is not None) and (analysis_tmp is not None):
+        check_same_filesystem(analysis_tmp, analysis_input)
+
+    if analysis_jpeg_quality < 0:
+        analysis_jpeg_quality = jpeg_quality
+    templates = None
+    if analysis_input is not None:
+        templates = AnalysisFiles(analysis_input, analysis_output, analysis_tmp, analysis_type, analysis_image_type)
+    watcher = None
+    if (analysis_output is not None) and use_inotify:
+        watcher = create_watcher(analysis_output, verbose=verbose)
 
     # open output
-    out = None
-    if output_type not in OUTPUT_TYPES:
-        raise Exception("Unknown output type: %s" % output_type)
-    if output_type == OUTPUT_MJPG:
-        if verbose:
-            log("Opening output video: %s" % output)
-        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        out = cv2.VideoWriter(output, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), output_fps, (frame_width, frame_height))
+    out = open_output(output, output_type, output_format, output_fps, cap, verbose=verbose,
+                      jpeg_quality=jpeg_quality)
+    if out is not None:
         crop_to_content = False
-    elif output_type == OUTPUT_JPG:
-        if (output_format % 1) == output_format:
-            raise Exception("Output format does not expand integers: %s" % output_format)
-    else:
-        raise Exception("Unhandled output type: %s" % output_type)
+    elif output_tmp is not None:
+        check_same_filesystem(output_tmp, output)
+    pool = None
+    writer = None
+    if out is None:
+        writer = FrameWriter(output, output_format, output_tmp, output_metadata, files=files,
+                             keep_original=keep_original, verbose=verbose, jpeg_quality=jpeg_quality,
+                             jpeg_optimize=jpeg_optimize, metadata_format=metadata_format).write
+        if num_writers > 1:
+            pool = FrameWriterPool(num_writers, write_fn=writer)
+            writer = pool.write
+    # without any analysis/pruning the image files get copied rather than decoded and re-encoded
+    copy_files = (files is not None) and (out is None) and keep_original and (analysis_input is None) and (not prune) and (not adaptive_skip)
 
     # iterate frames
     count = 0
     frames_count = 0
     frames_processed = 0
     frame_curr = None
-    frame_prev = None
+    gray_prev = None
+    if opencl:
+        opencl = enable_opencl(verbose=verbose)
+    skipper = None
+    if adaptive_skip:
+        skipper = AdaptiveSkipper(bw_threshold, skip_min, skip_max, skip_lambda, scale=prune_scale, use_umat=opencl)
+    # files identical to the one of the prune reference cannot be above the threshold, no need to decode them
+    skip_identical = prune and (files is not None) and (skipper is None) and (change_threshold >= 0)
+    ref_file = None
+    identical = False
+    # jump straight to the start of the frame window rather than decoding all the frames before it
+    if (input_type == INPUT_VIDEO) and (cap is not None) and (from_frame > 1):
+        if seek_video(cap, from_frame - 1, verbose=verbose):
+            frames_count = from_frame - 1
+            # as if the skipped frames had been counted
+            count = frames_count
+    if (cap is not None) and (prefetch > 0):
+        if input_type == INPUT_VIDEO:
+            # the background thread only retrieves the frames that the loop below selects
+            cap = BackgroundReader(cap, prefetch, nth_frame=1 if (skipper is not None) else nth_frame,
+                                   count=count, frames_count=frames_count, from_frame=from_frame)
+        else:
+            # reading ahead would only buffer stale frames (and defeat --capture_buffer)
+            log("Ignoring --prefetch for input type: %s" % input_type)
+    # local names for the functions called for every frame, avoids repeated global/attribute lookups
+    cap_read = None if (cap is None) else cap.read
+    # videos: only grab the frames and retrieve (convert/copy) the ones that are actually used
+    cap_grab = None
+    cap_retrieve = None
+    if (input_type == INPUT_VIDEO) and (cap is not None) and hasattr(cap, "grab"):
+        cap_grab = cap.grab
+        cap_retrieve = cap.retrieve
+    imread = cv2.imread
+    num_files = 0 if (files is None) else len(files)
+    prefetcher = None
+    if (files is not None) and (prefetch > 0) and (not copy_files):
+        prefetcher = ImagePrefetcher(files, prefetch)
     while ((cap is not None) and cap.isOpened()) or (files is not None):
         # next frame
-        if cap is not None:
-            retval, frame_curr = cap.read()
+        if cap_grab is not None:
+            retval = cap_grab()
+            frame_curr = None
+        elif cap is not None:
+            retval, frame_curr = cap_read()
         else:
-            retval = frames_count < len(files)
-            if retval:
-                frame_curr = cv2.imread(files[frames_count])
+            retval = frames_count < num_files
+            if retval and not copy_files:
+                identical = skip_identical and (ref_file is not None) and same_file(ref_file, files[frames_count])
+                if not identical:
+                    if prefetcher is not None:
+                        frame_curr = prefetcher.read(frames_count)
+                    else:
+                        frame_curr = imread(files[frames_count])
         count += 1
         frames_count += 1
 
@@ -310,23 +543,37 @@ def process(input, input_type, nth_frame, max_frames,
 
         # process frame
         if retval:
-            if count >= nth_frame:
+            if (cap_retrieve is not None) and ((skipper is not None) or (count >= nth_frame)):
+                retval, frame_curr = cap_retrieve()
+                if not retval:
+                    break
+            if skipper is not None:
+                selected = skipper.select(frame_curr)
+            else:
+                selected = count >= nth_frame
+            if selected:
                 count = 0
                 metadata = None
 
                 # prune?
                 if prune:
-                    # nothing to compare?
-                    if frame_prev is None:
-                        frame_prev = frame_curr
-                        frame_curr = None
+                    if identical:
+                        if verbose:
+                            log("Frame #%d identical to reference, skipping" % frames_count)
                         continue
                     try:
-                        change, above = detect_change(frame_prev, frame_curr, bw_threshold=bw_threshold,
-                                                      change_threshold=change_threshold)
+                        gray_curr = prepare_image(frame_curr, scale=prune_scale, use_umat=opencl)
+                        # nothing to compare?
+                        if gray_prev is None:
+                            gray_prev = gray_curr
+                            if skip_identical:
+                                ref_file = files[frames_count - 1]
+                            continue
+                        change, above = detect_change_prepared(gray_prev, gray_curr, bw_threshold=bw_threshold,
+                                                               change_threshold=change_threshold)
                     except Exception:
-                        frame_prev = None
-                        frame_curr = None
+                        gray_prev = None
+                        ref_file = None
                         log("Failed to compare frames (current frame: %d), skipping!" % frames_count)
                         traceback.print_exc()
                         continue
@@ -334,14 +581,20 @@ def process(input, input_type, nth_frame, max_frames,
                         if verbose:
                             log("Frame #%d not above threshold, skipping: %f < %f" % (frames_count, change, change_threshold))
                         continue
+                    # compare subsequent frames against this one
+                    gray_prev = gray_curr
+                    if skip_identical:
+                        ref_file = files[frames_count - 1]
 
                 # do we want to keep frame?
                 if analysis_input is not None:
                     keep, frame_curr, metadata = process_image(frame_curr, frames_count, analysis_input, analysis_output, analysis_tmp,
-                                                               analysis_timeout, analysis_type, analysis_keep_files, min_score,
+                                                               analysis_timeout, analysis_type, analysis_image_type,
+                                                               analysis_keep_files, analysis_jpeg_quality, min_score,
                                                                required_labels, excluded_labels, poll_interval,
                                                                crop_to_content, crop_margin, crop_min_width, crop_min_height,
-                                                               verbose)
+                                                               verbose, watcher=watcher, templates=templates,
+                                                               analysis_max_dim=analysis_max_dim)
                     if not keep:
                         continue
 
@@ -349,40 +602,10 @@ def process(input, input_type, nth_frame, max_frames,
 
                 if out is not None:
                     out.write(frame_curr)
+                elif copy_files:
+                    copy_file(files[frames_count - 1], output, output_tmp, verbose=verbose)
                 else:
-                    # keep original filename when using image_dir
-                    tmp_file = None
-                    if (files is not None) and keep_original:
-                        if output_tmp is not None:
-                            tmp_file = os.path.join(output_tmp, os.path.basename(files[frames_count - 1]))
-                        out_file = os.path.join(output, os.path.basename(files[frames_count - 1]))
-                    else:
-                        if output_tmp is not None:
-                            tmp_file = os.path.join(output_tmp, output_format % frames_count)
-                        out_file = os.path.join(output, output_format % frames_count)
-                    if output_tmp is not None:
-                        cv2.imwrite(tmp_file, frame_curr)
-                        os.rename(tmp_file, out_file)
-                        if verbose:
-                            log("Frame written to: %s" % out_file)
-                        if output_metadata and (metadata is not None):
-                            tmp_file = os.path.splitext(tmp_file)[0] + ".yaml"
-                            out_file = os.path.splitext(out_file)[0] + ".yaml"
-                            with open(tmp_file, "w") as yf:
-                                safe_dump(metadata, yf)
-                            os.rename(tmp_file, out_file)
-                            if verbose:
-                                log("Meta-data written to: %s" % out_file)
-                    else:
-                        cv2.imwrite(out_file, frame_curr)
-                        if verbose:
-                            log("Frame written to: %s" % out_file)
-                        if output_metadata and (metadata is not None):
-                            out_file = os.path.splitext(out_file)[0] + ".yaml"
-                            with open(out_file, "w") as yf:
-                                safe_dump(metadata, yf)
-                            if verbose:
-                                log("Meta-data written to: %s" % out_file)
+                    writer(frame_curr, frames_count, metadata)
         else:
             break
 
@@ -390,8 +613,14 @@ def process(input, input_type, nth_frame, max_frames,
 
     if cap is not None:
         cap.release()
+    if prefetcher is not None:
+        prefetcher.close()
+    if watcher is not None:
+        watcher.close()
     if out is not None:
         out.release()
+    if pool is not None:
+        pool.close()
 
 
 def main(args=None):
@@ -408,59 +637,87 @@ def main(args=None):
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--input", metavar="DIR_OR_FILE_OR_ID", help="the dir with images, video file to read or the webcam ID", required=True)
     parser.add_argument("--input_type", help="the input type", choices=INPUT_TYPES, required=True)
+    parser.add_argument("--prefetch", metavar="INT", help="the number of images/video frames to read ahead in background threads, only the selected video frames get decoded (<= 0 to turn off); ignored for webcams, as it would only buffer stale frames", required=False, type=int, default=0)
+    parser.add_argument("--decoder", help="the decoder to use for videos (pyav requires PyAV to be installed; gstreamer requires OpenCV with GStreamer support, the input can be a video file or a GStreamer pipeline ending in appsink)", choices=DECODERS, required=False, default=DECODER_OPENCV)
+    parser.add_argument("--hw_decode", help="the type of hardware acceleration to use for decoding videos (opencv decoder)", choices=HW_DECODE_TYPES, required=False, default=HW_DECODE_NONE)
+    parser.add_argument("--capture_buffer", metavar="INT", help="the number of frames to buffer when capturing from a webcam, e.g., 1 for always processing the most recent frame (not supported by all backends); uses the backend's default if <= 0", required=False, type=int, default=-1)
+    parser.add_argument("--scan_threads", metavar="INT", help="the number of threads to use for scanning the image dir, e.g., for hiding the latency of network file systems (only used for larger directories)", required=False, type=int, default=1)
     parser.add_argument("--nth_frame", metavar="INT", help="every nth frame gets presented to the analysis process", required=False, type=int, default=10)
     parser.add_argument("--max_frames", metavar="INT", help="the maximum number of processed frames before exiting (<=0 for unlimited)", required=False, type=int, default=0)
     parser.add_argument("--from_frame", metavar="INT", help="the starting frame (incl.); ignored if <= 0", required=False, type=int, default=-1)
     parser.add_argument("--to_frame", metavar="INT", help="the last frame to process (incl.); ignored if <= 0", required=False, type=int, default=-1)
     parser.add_argument("--prune", help="whether to prune the images if not enough change", action="store_true", required=False)
-    parser.add_argument("--bw_threshold", metavar="INT", default=128, type=int, help="The threshold (0-255) for the black/white conversion (requires --prune)")
+    parser.add_argument("--bw_threshold", metavar="INT", default=128, type=int, help="The threshold (0-255) for the black/white conversion (requires --prune or --adaptive_skip)")
     parser.add_argument("--change_threshold", metavar="FLOAT", default=0.0, type=float, help="The threshold (0.0-1.0) for the change detection (requires --prune)")
+    parser.add_argument("--prune_scale", metavar="FLOAT", default=1.0, type=float, help="The scale factor to apply to the frames before the change detection, e.g., 0.25 for a quarter of the width/height (requires --prune or --adaptive_skip)")
+    parser.add_argument("--adaptive_skip", help="whether to select the frames based on the change accumulated since the last selected frame rather than every nth frame (--nth_frame gets ignored)", action="store_true", required=False)
+    parser.add_argument("--skip_min", metavar="INT", default=0, type=int, help="The minimum number of frames to skip after a selected frame (requires --adaptive_skip)")
+    parser.add_argument("--skip_max", metavar="INT", default=-1, type=int, help="The maximum number of frames to skip after a selected frame; ignored if <= 0 (requires --adaptive_skip)")
+    parser.add_argument("--skip_lambda", metavar="FLOAT", default=0.5, type=float, help="The accumulated change ratio at which to select the next frame (requires --adaptive_skip)")
+    parser.add_argument("--opencl", help="whether to use OpenCL (if available) for the change detection (--prune/--adaptive_skip)", action="store_true", required=False)
     parser.add_argument("--analysis_input", metavar="DIR", help="the input directory used by the image analysis process; if not provided, all frames get accepted", required=False)
-    parser.add_argument("--analysis_tmp", metavar="DIR", help="the temporary directory to place the images in before moving them into the actual input directory (to avoid race conditions)", required=False)
+    parser.add_argument("--analysis_tmp", metavar="DIR", help="the temporary directory to place the images in before moving them into the actual input directory (to avoid race conditions; must be on the same filesystem)", required=False)
     parser.add_argument("--analysis_output", metavar="DIR", help="the output directory used by the image analysis process", required=False)
     parser.add_argument("--analysis_timeout", metavar="SECONDS", help="the maximum number of seconds to wait for the image analysis to finish processing", required=False, type=float, default=10)
     parser.add_argument("--analysis_type", help="the type of output the analysis process generates", choices=ANALYSIS_TYPES, required=False, default=ANALYSIS_TYPES[0])
+    parser.add_argument("--analysis_image_type", help="the type of image to present the frames as to the image analysis process (bmp avoids compression, npy writes the raw BGR array in numpy format, e.g., for an analysis input dir in /dev/shm)", choices=ANALYSIS_IMAGE_TYPES, required=False, default=ANALYSIS_IMAGE_TYPES[0])
+    parser.add_argument("--analysis_max_dim", metavar="INT", help="the maximum width/height of the images presented to the image analysis, larger frames get scaled down (predictions get scaled back up for cropping); no scaling if <= 0", required=False, type=int, default=-1)
+    parser.add_argument("--analysis_jpeg_quality", metavar="INT", help="the quality (0-100) to use for the JPEG images presented to the image analysis; uses --jpeg_quality if < 0", required=False, type=int, default=-1)
     parser.add_argument("--analysis_keep_files", help="whether to keep the analysis files rather than deleting them", action="store_true", required=False)
     parser.add_argument("--min_score", metavar="FLOAT", help="the minimum score that a prediction must have", required=False, type=float, default=0.0)
     parser.add_argument("--required_labels", metavar="LIST", help="the comma-separated list of labels that the analysis output must contain (with high enough scores)", required=False)
     parser.add_argument("--excluded_labels", metavar="LIST", help="the comma-separated list of labels that the analysis output must not contain (with high enough scores)", required=False)
+    parser.add_argument("--use_inotify", help="whether to use inotify (Linux only, requires inotify_simple) for detecting the analysis output rather than polling; the output dir must be on a local filesystem", action="store_true", required=False)
     parser.add_argument('--poll_interval', type=float, help='interval in seconds for polling for result files', required=False, default=0.1)
     parser.add_argument("--output", metavar="DIR_OR_FILE", help="the output directory or file for storing the selected frames (use .avi or .mkv for videos)", required=True)
     parser.add_argument("--output_type", help="the type of output to generate", choices=OUTPUT_TYPES, required=True)
     parser.add_argument("--output_format", metavar="FORMAT", help="the format string for the images, see https://docs.python.org/3/library/stdtypes.html#old-string-formatting", required=False, default="%06d.jpg")
-    parser.add_argument("--output_tmp", metavar="DIR", help="the temporary directory to write the output images to before moving them to the output directory (to avoid race conditions with processes that pick up the images)", required=False)
+    parser.add_argument("--output_tmp", metavar="DIR", help="the temporary directory to write the output images to before moving them to the output directory (to avoid race conditions with processes that pick up the images; must be on the same filesystem)", required=False)
     parser.add_argument("--output_fps", metavar="FORMAT", help="the frames per second to use when generating a video", required=False, type=int, default=25)
+    parser.add_argument("--jpeg_quality", metavar="INT", help="the quality (0-100) to use when encoding JPEG images", required=False, type=int, default=JPEG_QUALITY)
+    parser.add_argument("--jpeg_optimize", help="whether to use optimized Huffman tables for the output JPEG images (smaller files, slightly slower encoding)", action="store_true", required=False)
+    parser.add_argument("--num_writers", metavar="INT", help="the number of threads to use for writing the output images in the background (<= 1 for no background threads)", required=False, type=int, default=1)
     parser.add_argument("--crop_to_content", help="whether to crop the frame to the detected content", action="store_true", required=False)
     parser.add_argument("--crop_margin", metavar="INT", help="the margin in pixels to use around the determined crop region", required=False, type=int, default=0)
     parser.add_argument("--crop_min_width", metavar="INT", help="the minimum width for the cropped content", required=False, type=int, default=2)
     parser.add_argument("--crop_min_height", metavar="INT", help="the minimum height for the cropped content", required=False, type=int, default=2)
-    parser.add_argument("--output_metadata", help="whether to output a YAML file alongside the image with some metadata when outputting frame images", required=False, action="store_true")
+    parser.add_argument("--output_metadata", help="whether to output a YAML/JSON file alongside the image with some metadata when outputting frame images", required=False, action="store_true")
+    parser.add_argument("--metadata_format", help="the format to use for the metadata files (json uses orjson if installed)", choices=METADATA_FORMATS, required=False, default=METADATA_YAML)
     parser.add_argument("--progress", metavar="INT", help="every nth frame a progress message is output on stdout", required=False, type=int, default=100)
-    parser.add_argument("--keep_original", help="keeps the original file name when processing an image dir", action="store_true", required=False)
+    parser.add_argument("--keep_original", help="keeps the original file name when processing an image dir (without analysis or pruning, the files get copied as is)", action="store_true", required=False)
     parser.add_argument("--verbose", help="for more verbose output", action="store_true", required=False)
     parsed = parser.parse_args(args=args)
 
     # parse labels
     required_labels = None
     if parsed.required_labels is not None:
-        required_labels = parsed.required_labels.split(",")
+        required_labels = frozenset(parsed.required_labels.split(","))
     excluded_labels = None
     if parsed.excluded_labels is not None:
-        excluded_labels = parsed.excluded_labels.split(",")
+        excluded_labels = frozenset(parsed.excluded_labels.split(","))
 
     process(input=parsed.input, input_type=parsed.input_type, nth_frame=parsed.nth_frame, max_frames=parsed.max_frames,
             analysis_input=parsed.analysis_input, analysis_output=parsed.analysis_output,
             analysis_tmp=parsed.analysis_tmp, analysis_timeout=parsed.analysis_timeout,
-            analysis_type=parsed.analysis_type, analysis_keep_files=parsed.analysis_keep_files,
+            analysis_type=parsed.analysis_type, analysis_image_type=parsed.analysis_image_type,
+            analysis_keep_files=parsed.analysis_keep_files,
             from_frame=parsed.from_frame, to_frame=parsed.to_frame,
             min_score=parsed.min_score, required_labels=required_labels, excluded_labels=excluded_labels,
             poll_interval=parsed.poll_interval,
             output=parsed.output, output_type=parsed.output_type, output_format=parsed.output_format,
             output_tmp=parsed.output_tmp, output_fps=parsed.output_fps, output_metadata=parsed.output_metadata,
+            jpeg_quality=parsed.jpeg_quality, jpeg_optimize=parsed.jpeg_optimize,
+            num_writers=parsed.num_writers,
             crop_to_content=parsed.crop_to_content, crop_margin=parsed.crop_margin,
             crop_min_width=parsed.crop_min_width, crop_min_height=parsed.crop_min_height,
             verbose=parsed.verbose, progress=parsed.progress, keep_original=parsed.keep_original,
-            prune=parsed.prune, bw_threshold=parsed.bw_threshold, change_threshold=parsed.change_threshold)
+            prune=parsed.prune, bw_threshold=parsed.bw_threshold, change_threshold=parsed.change_threshold,
+            prune_scale=parsed.prune_scale, hw_decode=parsed.hw_decode, adaptive_skip=parsed.adaptive_skip,
+            skip_min=parsed.skip_min, skip_max=parsed.skip_max, skip_lambda=parsed.skip_lambda,
+            opencl=parsed.opencl, decoder=parsed.decoder,
+            prefetch=parsed.prefetch, use_inotify=parsed.use_inotify, metadata_format=parsed.metadata_format,
+            analysis_max_dim=parsed.analysis_max_dim, analysis_jpeg_quality=parsed.analysis_jpeg_quality,
+            capture_buffer=parsed.capture_buffer, scan_threads=parsed.scan_threads)
 
 
 def sys_main():
@@ -1,17 +1,17 @@
 import argparse
 import cv2
-import os
 import redis
+import threading
 import traceback
-from datetime import datetime
-from time import sleep
-from yaml import safe_dump
 
-from vfs.common import INPUT_IMAGE_DIR, INPUT_VIDEO, INPUT_WEBCAM, INPUT_TYPES, ANALYSIS_ROISCSV, ANALYSIS_OPEXJSON, \
-    ANALYSIS_TYPES, OUTPUT_JPG, OUTPUT_MJPG, OUTPUT_TYPES, list_images
-from vfs.predictions import load_roiscsv_from_str, load_opexjson_from_str, crop_frame, check_predictions
+from vfs.common import INPUT_TYPES, INPUT_VIDEO, HW_DECODE_TYPES, HW_DECODE_NONE, DECODERS, DECODER_OPENCV, \
+    ANALYSIS_ROISCSV, ANALYSIS_OPEXJSON, ANALYSIS_TYPES, OUTPUT_TYPES, JPEG_QUALITY, FrameWriterPool, \
+    ImagePrefetcher, BackgroundReader, open_input, seek_video, resize_frame, open_output, FrameWriter, \
+    METADATA_FORMATS, METADATA_YAML, check_same_filesystem
+from vfs.predictions import load_roiscsv_from_str, load_opexjson_from_str, crop_frame, check_predictions, \
+    PredictionsBatch
 from vfs.logging import log
-from vfs.prune import detect_change
+from vfs.prune import enable_opencl, same_file, prepare_image, detect_change_prepared, AdaptiveSkipper
 
 
 def load_output(analysis_str, analysis_type, metadata):
@@ -42,6 +42,8 @@ def load_output(analysis_str, analysis_type, metadata):
 class RedisConnection(object):
     """
     Container class to encapsulate the redis connection.
+    The subscription to the input channel gets established once and kept open
+    for all the frames, with a single background thread receiving the messages.
     """
 
     def __init__(self):
@@ -52,12 +54,61 @@ class RedisConnection(object):
         self.channel_in = None
         self.timeout = None
         self.data = None
+        self.event = threading.Event()
+
+    def _handler(self, message):
+        """
+        Gets called by the background thread for each message received on the input channel.
+
+        :param message: the message
+        :type message: dict
+        """
+        self.data = message['data']
+        self.event.set()
+
+    def subscribe(self):
+        """
+        Subscribes to the input channel (if not already subscribed) and starts the background thread.
+        """
+        if self.pubsub is not None:
+            return
+        self.pubsub = self.redis.pubsub()
+        self.pubsub.psubscribe(**{self.channel_in: self._handler})
+        # wait for the confirmation, otherwise the first analysis result could get missed
+        self.pubsub.get_message(timeout=1.0)
+        self.pubsub_thread = self.pubsub.run_in_thread(sleep_time=0.001, daemon=True)
+
+    def close(self):
+        """
+        Stops the background thread and closes the subscription.
+        """
+        if self.pubsub_thread is not None:
+            self.pubsub_thread.stop()
+            self.pubsub_thread.join()
+            self.pubsub_thread = None
+        if self.pubsub is not None:
+            self.pubsub.close()
+            self.pubsub = None
+
+
+def encode_jpeg(frame, jpeg_quality):
+    """
+    Encodes the frame as JPEG for sending it to the image analysis process.
 
+    :param frame: the frame to encode
+    :type frame: ndarray
+    :param jpeg_quality: the quality (0-100) to use
+    :type jpeg_quality: int
+    :return: the JPEG, a view on the encoded array to avoid copying it into a bytes object
+    :rtype: memoryview
+    """
+    return memoryview(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1]).cast("B")
 
-def process_image(frame, frameno, redis_conn, analysis_type,
+
+def process_image(frame, frameno, redis_conn, analysis_type, jpeg_quality,
                   min_score, required_labels, excluded_labels,
                   crop_to_content, crop_margin, crop_min_width, crop_min_height,
-                  verbose):
+                  verbose, frame_jpg=None, frame_scale=1.0):
     """
     Pushes a frame through the image analysis framework and returns whether to keep it or not.
 
@@ -69,12 +120,14 @@ def process_image(frame, frameno, redis_conn, analysis_type,
     :type redis_conn: RedisConnection
     :param analysis_type: the type of output the analysis is generated, see ANALYSIS_TYPES
     :type analysis_type: str
+    :param jpeg_quality: the quality (0-100) to use for encoding the frame as JPEG
+    :type jpeg_quality: int
     :param min_score: the minimum score that the predictions have to have
     :type min_score: float
     :param required_labels: the list of labels that must have the specified min_score, ignored if None or empty
-    :type required_labels: list or None
+    :type required_labels: list or set or None
     :param excluded_labels: the list of labels that must not have the specified min_score, ignored if None or empty
-    :type excluded_labels: list or None
+    :type excluded_labels: list or set or None
     :param crop_to_content: whether to crop the frame to the content (eg bounding boxes)
     :type crop_to_content: bool
     :param crop_margin: the margin to use around the cropped content
@@ -85,41 +138,35 @@ def process_image(frame, frameno, redis_conn, analysis_type,
     :type crop_min_height: int
     :param verbose: whether to print some logging information
     :type verbose: bool
+    :param frame_jpg: the frame already encoded as JPEG, gets encoded with jpeg_quality if None
+    :type frame_jpg: bytes or memoryview
+    :param frame_scale: the scale factor that was applied to the frame before encoding it as frame_jpg
+    :type frame_scale: float
     :return: tuple (whether to keep the frame or skip it, potentially cropped frame, metadata)
     :rtype: tuple
     """
-    frame_str = cv2.imencode('.jpg', frame)[1].tobytes()
+    if frame_jpg is None:
+        frame_jpg = encode_jpeg(frame, jpeg_quality)
     metadata = dict()
 
-    def anon_handler(message):
-        data = message['data']
-        redis_conn.data = data
-        redis_conn.pubsub_thread.stop()
-        redis_conn.pubsub.close()
-        redis_conn.pubsub = None
-
-    redis_conn.pubsub = redis_conn.redis.pubsub()
-    redis_conn.pubsub.psubscribe(**{redis_conn.channel_in: anon_handler})
-    redis_conn.pubsub_thread = redis_conn.pubsub.run_in_thread(sleep_time=0.001)
-    redis_conn.redis.publish(redis_conn.channel_out, frame_str)
+    redis_conn.subscribe()
+    redis_conn.event.clear()
+    redis_conn.data = None
+    redis_conn.redis.publish(redis_conn.channel_out, frame_jpg)
 
     # wait for data to show up
-    start = datetime.now()
-    no_data = False
-    while redis_conn.pubsub is not None:
-        sleep(0.01)
-        if redis_conn.timeout > 0:
-            end = datetime.now()
-            if (end - start).total_seconds() >= redis_conn.timeout:
-                if verbose:
-                    log("Timeout reached!")
-                no_data = True
-                break
-
-    if no_data:
+    if not redis_conn.event.wait(redis_conn.timeout if (redis_conn.timeout > 0) else None):
+        if verbose:
+            log("Timeout reached!")
         return False, frame, metadata
 
     predictions = load_output(redis_conn.data, analysis_type, metadata)
+    if crop_to_content and (len(predictions) > 0):
+        # labels get checked and the crop region determined with the same column-oriented batch
+        predictions = PredictionsBatch.from_predictions(predictions)
+        if frame_scale != 1.0:
+            # predictions were made on the scaled frame
+            predictions = predictions.scaled(1.0 / frame_scale)
     result = check_predictions(predictions, min_score, required_labels, excluded_labels, verbose)
     if verbose:
         log("Can be included: %s" % str(result))
@@ -134,13 +181,17 @@ def process_image(frame, frameno, redis_conn, analysis_type,
 def process(input, input_type, nth_frame, max_frames, redis_conn,
             analysis_type, from_frame, to_frame,
             min_score, required_labels, excluded_labels,
-            output, output_type, output_format, output_tmp, output_fps, output_metadata,
+            output, output_type, output_format, output_tmp, output_fps, output_metadata, jpeg_quality,
+            jpeg_optimize, num_writers,
             crop_to_content, crop_margin, crop_min_width, crop_min_height,
-            verbose, progress, keep_original, prune, bw_threshold, change_threshold):
+            verbose, progress, keep_original, prune, bw_threshold, change_threshold,
+            prune_scale, hw_decode, adaptive_skip, skip_min, skip_max, skip_lambda,
+            opencl, decoder, prefetch, metadata_format, analysis_max_dim, analysis_jpeg_quality,
+            capture_buffer, scan_threads):
     """
     Processes the input video or webcam feed.
     
-    :param input: the input dir, video or webcam ID
+    :param input: the input dir, video, webcam ID or GStreamer pipeline (gstreamer decoder)
     :type input: str
     :param input_type: the type of input, INPUT_TYPES
     :type input_type: str
@@ -159,9 +210,9 @@ def process(input, input_type, nth_frame, max_frames, redis_conn,
     :param min_score: the minimum score that the predictions have to have
     :type min_score: float
     :param required_labels: the list of labels that must have the specified min_score, ignored if None or empty
-    :type required_labels: list
+    :type required_labels: list or set
     :param excluded_labels: the list of labels that must not have the specified min_score, ignored if None or empty
-    :type excluded_labels: list
+    :type excluded_labels: list or set
     :param output: the output video oor directory for output images
     :type output: str
     :param output_type: the type of output to generate, see OUTPUT_TYPES
@@ -172,8 +223,14 @@ def process(input, input_type, nth_frame, max_frames, redis_conn,
     :type output_tmp: str
     :param output_fps: the frames-per-second to use when generating an output video
     :type output_fps: int
-    :param output_metadata: whether to output metadata as YAML file alongside JPG frames
+    :param output_metadata: whether to output metadata as YAML/JSON file alongside JPG frames
     :type output_metadata: bool
+    :param jpeg_quality: the quality (0-100) to use for encoding JPEG images
+    :type jpeg_quality: int
+    :param jpeg_optimize: whether to use optimized Huffman tables for the output JPEG images
+    :type jpeg_optimize: bool
+    :param num_writers: the number of threads to use for writing output images, no threads if <= 1
+    :type num_writers: int
     :param crop_to_content: whether to crop the frame to the content (eg bounding boxes)
     :type crop_to_content: bool
     :param crop_margin: the margin to use around the cropped content
@@ -190,29 +247,43 @@ def process(input, input_type, nth_frame, max_frames, redis_conn,
     :type keep_original: bool
     :param prune: whether to discard images if they isn't enough change between them
     :type prune: bool
-    :param bw_threshold: the threshold (0-255) for the black/white conversion (requires prune)
+    :param bw_threshold: the threshold (0-255) for the black/white conversion (requires prune or adaptive_skip)
     :type bw_threshold: int
     :param change_threshold: the threshold (0.0-1.0) for the change detection (requires prune)
     :type change_threshold: float
+    :param prune_scale: the scale factor to apply to the frames before the change detection (requires prune or adaptive_skip)
+    :type prune_scale: float
+    :param hw_decode: the type of hardware acceleration to use for decoding videos (opencv decoder), HW_DECODE_TYPES
+    :type hw_decode: str
+    :param adaptive_skip: whether to select the frames based on the accumulated change rather than every nth frame
+    :type adaptive_skip: bool
+    :param skip_min: the minimum number of frames to skip after a selected frame (requires adaptive_skip)
+    :type skip_min: int
+    :param skip_max: the maximum number of frames to skip after a selected frame, ignored if <= 0 (requires adaptive_skip)
+    :type skip_max: int
+    :param skip_lambda: the accumulated change ratio at which to select the next frame (requires adaptive_skip)
+    :type skip_lambda: float
+    :param opencl: whether to use OpenCL (if available) for the change detection (prune/adaptive_skip)
+    :type opencl: bool
+    :param decoder: the decoder to use for videos, DECODERS
+    :type decoder: str
+    :param prefetch: the number of images/video frames to read ahead in background threads, off if <= 0, ignored for webcams
+    :type prefetch: int
+    :param metadata_format: the format for the metadata files, see METADATA_FORMATS
+    :type metadata_format: str
+    :param analysis_max_dim: the maximum width/height of the frames sent to the analysis, larger ones get scaled down; no scaling if <= 0
+    :type analysis_max_dim: int
+    :param analysis_jpeg_quality: the quality (0-100) for encoding the frames sent to the analysis, uses jpeg_quality if < 0
+    :type analysis_jpeg_quality: int
+    :param capture_buffer: the number of frames to buffer when capturing from a webcam, uses the backend's default if <= 0
+    :type capture_buffer: int
+    :param scan_threads: the number of threads to use for scanning the image dir (eg on network file systems)
+    :type scan_threads: int
     """
 
     # open input
-    if input_type not in INPUT_TYPES:
-        raise Exception("Unknown input type: %s" % input_type)
-    cap = None
-    files = None
-    if input_type == INPUT_IMAGE_DIR:
-        files = list_images(input, verbose=verbose)
-    elif input_type == INPUT_VIDEO:
-        if verbose:
-            log("Opening input video: %s" % input)
-        cap = cv2.VideoCapture(input)
-    elif input_type == INPUT_WEBCAM:
-        if verbose:
-            log("Opening webcam: %s" % input)
-        cap = cv2.VideoCapture(int(input))
-    else:
-        raise Exception("Unhandled input type: %s" % input_type)
+    cap, files = open_input(input, input_type, verbose=verbose, hw_decode=hw_decode, decoder=decoder,
+                            capture_buffer=capture_buffer, scan_threads=scan_threads)
 
     # frames
     if (from_frame > 0) and (to_frame > 0):
@@ -224,36 +295,84 @@ def process(input, input_type, nth_frame, max_frames, redis_conn,
         raise Exception("Unknown analysis type: %s" % analysis_type)
 
     # open output
-    out = None
-    if output_type not in OUTPUT_TYPES:
-        raise Exception("Unknown output type: %s" % output_type)
-    if output_type == OUTPUT_MJPG:
-        if verbose:
-            log("Opening output video: %s" % output)
-        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        out = cv2.VideoWriter(output, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), output_fps, (frame_width, frame_height))
+    out = open_output(output, output_type, output_format, output_fps, cap, verbose=verbose,
+                      jpeg_quality=jpeg_quality)
+    if out is not None:
         crop_to_content = False
-    elif output_type == OUTPUT_JPG:
-        if (output_format % 1) == output_format:
-            raise Exception("Output format does not expand integers: %s" % output_format)
-    else:
-        raise Exception("Unhandled output type: %s" % output_type)
+    elif output_tmp is not None:
+        check_same_filesystem(output_tmp, output)
+    pool = None
+    writer = None
+    if out is None:
+        writer = FrameWriter(output, output_format, output_tmp, output_metadata, files=files,
+                             keep_original=keep_original, verbose=verbose, jpeg_quality=jpeg_quality,
+                             jpeg_optimize=jpeg_optimize, metadata_format=metadata_format).write
+        if num_writers > 1:
+            pool = FrameWriterPool(num_writers, write_fn=writer)
+            writer = pool.write
+    if analysis_jpeg_quality < 0:
+        analysis_jpeg_quality = jpeg_quality
+    # the JPEG sent to the analysis can only be written as is if it was encoded the same way
+    reuse_jpg = analysis_jpeg_quality == jpeg_quality
 
     # iterate frames
     count = 0
     frames_count = 0
     frames_processed = 0
     frame_curr = None
-    frame_prev = None
+    gray_prev = None
+    if opencl:
+        opencl = enable_opencl(verbose=verbose)
+    skipper = None
+    if adaptive_skip:
+        skipper = AdaptiveSkipper(bw_threshold, skip_min, skip_max, skip_lambda, scale=prune_scale, use_umat=opencl)
+    # files identical to the one of the prune reference cannot be above the threshold, no need to decode them
+    skip_identical = prune and (files is not None) and (skipper is None) and (change_threshold >= 0)
+    ref_file = None
+    identical = False
+    # jump straight to the start of the frame window rather than decoding all the frames before it
+    if (input_type == INPUT_VIDEO) and (cap is not None) and (from_frame > 1):
+        if seek_video(cap, from_frame - 1, verbose=verbose):
+            frames_count = from_frame - 1
+            # as if the skipped frames had been counted
+            count = frames_count
+    if (cap is not None) and (prefetch > 0):
+        if input_type == INPUT_VIDEO:
+            # the background thread only retrieves the frames that the loop below selects
+            cap = BackgroundReader(cap, prefetch, nth_frame=1 if (skipper is not None) else nth_frame,
+                                   count=count, frames_count=frames_count, from_frame=from_frame)
+        else:
+            # reading ahead would only buffer stale frames (and defeat --capture_buffer)
+            log("Ignoring --prefetch for input type: %s" % input_type)
+    # local names for the functions called for every frame, avoids repeated global/attribute lookups
+    cap_read = None if (cap is None) else cap.read
+    # videos: only grab the frames and retrieve (convert/copy) the ones that are actually used
+    cap_grab = None
+    cap_retrieve = None
+    if (input_type == INPUT_VIDEO) and (cap is not None) and hasattr(cap, "grab"):
+        cap_grab = cap.grab
+        cap_retrieve = cap.retrieve
+    imread = cv2.imread
+    num_files = 0 if (files is None) else len(files)
+    prefetcher = None
+    if (files is not None) and (prefetch > 0):
+        prefetcher = ImagePrefetcher(files, prefetch)
     while ((cap is not None) and cap.isOpened()) or (files is not None):
         # next frame
-        if cap is not None:
-            retval, frame_curr = cap.read()
+        if cap_grab is not None:
+            retval = cap_grab()
+            frame_curr = None
+        elif cap is not None:
+            retval, frame_curr = cap_read()
         else:
-            retval = frames_count < len(files)
+            retval = frames_count < num_files
             if retval:
-                frame_curr = cv2.imread(files[frames_count])
+                identical = skip_identical and (ref_file is not None) and same_file(ref_file, files[frames_count])
+                if not identical:
+                    if prefetcher is not None:
+                        frame_curr = prefetcher.read(frames_count)
+                    else:
+                        frame_curr = imread(files[frames_count])
         count += 1
         frames_count += 1
 
@@ -274,22 +393,36 @@ def process(input, input_type, nth_frame, max_frames, redis_conn,
 
         # process frame
         if retval:
-            if count >= nth_frame:
+            if (cap_retrieve is not None) and ((skipper is not None) or (count >= nth_frame)):
+                retval, frame_curr = cap_retrieve()
+                if not retval:
+                    break
+            if skipper is not None:
+                selected = skipper.select(frame_curr)
+            else:
+                selected = count >= nth_frame
+            if selected:
                 count = 0
 
                 # prune?
                 if prune:
-                    # nothing to compare?
-                    if frame_prev is None:
-                        frame_prev = frame_curr
-                        frame_curr = None
+                    if identical:
+                        if verbose:
+                            log("Frame #%d identical to reference, skipping" % frames_count)
                         continue
                     try:
-                        change, above = detect_change(frame_prev, frame_curr, bw_threshold=bw_threshold,
-                                                      change_threshold=change_threshold)
+                        gray_curr = prepare_image(frame_curr, scale=prune_scale, use_umat=opencl)
+                        # nothing to compare?
+                        if gray_prev is None:
+                            gray_prev = gray_curr
+                            if skip_identical:
+                                ref_file = files[frames_count - 1]
+                            continue
+                        change, above = detect_change_prepared(gray_prev, gray_curr, bw_threshold=bw_threshold,
+                                                               change_threshold=change_threshold)
                     except Exception:
-                        frame_prev = None
-                        frame_curr = None
+                        gray_prev = None
+                        ref_file = None
                         log("Failed to compare frames (current frame: %d), skipping!" % frames_count)
                         traceback.print_exc()
                         continue
@@ -297,52 +430,31 @@ def process(input, input_type, nth_frame, max_frames, redis_conn,
                         if verbose:
                             log("Frame #%d not above threshold, skipping: %f < %f" % (frames_count, change, change_threshold))
                         continue
+                    # compare subsequent frames against this one
+                    gray_prev = gray_curr
+                    if skip_identical:
+                        ref_file = files[frames_count - 1]
 
                 # do we want to keep frame?
-                keep, frame, metadata = process_image(frame, frames_count, redis_conn, analysis_type, min_score,
-                                                      required_labels, excluded_labels, crop_to_content,
-                                                      crop_margin, crop_min_width, crop_min_height, verbose)
+                frame_analysis, frame_scale = resize_frame(frame_curr, analysis_max_dim)
+                frame_jpg = encode_jpeg(frame_analysis, analysis_jpeg_quality)
+                keep, frame_kept, metadata = process_image(frame_curr, frames_count, redis_conn, analysis_type,
+                                                           analysis_jpeg_quality, min_score, required_labels,
+                                                           excluded_labels, crop_to_content, crop_margin,
+                                                           crop_min_width, crop_min_height, verbose,
+                                                           frame_jpg=frame_jpg, frame_scale=frame_scale)
                 if not keep:
                     continue
 
                 frames_processed += 1
 
                 if out is not None:
-                    out.write(frame_curr)
+                    out.write(frame_kept)
+                elif reuse_jpg and (frame_kept is frame_curr) and (frame_analysis is frame_curr):
+                    # not cropped, the JPEG that was sent to the analysis can be written as is
+                    writer(frame_kept, frames_count, metadata, encoded=frame_jpg)
                 else:
-                    # keep original filename when using image_dir
-                    tmp_file = None
-                    if (files is not None) and keep_original:
-                        if output_tmp is not None:
-                            tmp_file = os.path.join(output_tmp, os.path.basename(files[frames_count - 1]))
-                        out_file = os.path.join(output, os.path.basename(files[frames_count - 1]))
-                    else:
-                        if output_tmp is not None:
-                            tmp_file = os.path.join(output_tmp, output_format % frames_count)
-                        out_file = os.path.join(output, output_format % frames_count)
-                    if output_tmp is not None:
-                        cv2.imwrite(tmp_file, frame_curr)
-                        os.rename(tmp_file, out_file)
-                        if verbose:
-                            log("Frame written to: %s" % out_file)
-                        if output_metadata and (metadata is not None):
-                            tmp_file = os.path.splitext(tmp_file)[0] + ".yaml"
-                            out_file = os.path.splitext(out_file)[0] + ".yaml"
-                            with open(tmp_file, "w") as yf:
-                                safe_dump(metadata, yf)
-                            os.rename(tmp_file, out_file)
-                            if verbose:
-                                log("Meta-data written to: %s" % out_file)
-                    else:
-                        cv2.imwrite(out_file, frame_curr)
-                        if verbose:
-                            log("Frame written to: %s" % out_file)
-                        if output_metadata and (metadata is not None):
-                            out_file = os.path.splitext(out_file)[0] + ".yaml"
-                            with open(out_file, "w") as yf:
-                                safe_dump(metadata, yf)
-                            if verbose:
-                                log("Meta-data written to: %s" % out_file)
+                    writer(frame_kept, frames_count, metadata)
         else:
             break
 
@@ -350,8 +462,12 @@ def process(input, input_type, nth_frame, max_frames, redis_conn,
 
     if cap is not None:
         cap.release()
+    if prefetcher is not None:
+        prefetcher.close()
     if out is not None:
         out.release()
+    if pool is not None:
+        pool.close()
 
 
 def main(args=None):
@@ -368,13 +484,24 @@ def main(args=None):
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--input", metavar="DIR_OR_FILE_OR_ID", help="the dir with images, video file to read or the webcam ID", required=True)
     parser.add_argument("--input_type", help="the input type", choices=INPUT_TYPES, required=True)
+    parser.add_argument("--prefetch", metavar="INT", help="the number of images/video frames to read ahead in background threads, only the selected video frames get decoded (<= 0 to turn off); ignored for webcams, as it would only buffer stale frames", required=False, type=int, default=0)
+    parser.add_argument("--decoder", help="the decoder to use for videos (pyav requires PyAV to be installed; gstreamer requires OpenCV with GStreamer support, the input can be a video file or a GStreamer pipeline ending in appsink)", choices=DECODERS, required=False, default=DECODER_OPENCV)
+    parser.add_argument("--hw_decode", help="the type of hardware acceleration to use for decoding videos (opencv decoder)", choices=HW_DECODE_TYPES, required=False, default=HW_DECODE_NONE)
+    parser.add_argument("--capture_buffer", metavar="INT", help="the number of frames to buffer when capturing from a webcam, e.g., 1 for always processing the most recent frame (not supported by all backends); uses the backend's default if <= 0", required=False, type=int, default=-1)
+    parser.add_argument("--scan_threads", metavar="INT", help="the number of threads to use for scanning the image dir, e.g., for hiding the latency of network file systems (only used for larger directories)", required=False, type=int, default=1)
     parser.add_argument("--nth_frame", metavar="INT", help="every nth frame gets presented to the analysis process", required=False, type=int, default=10)
     parser.add_argument("--max_frames", metavar="INT", help="the maximum number of processed frames before exiting (<=0 for unlimited)", required=False, type=int, default=0)
     parser.add_argument("--from_frame", metavar="INT", help="the starting frame (incl.); ignored if <= 0", required=False, type=int, default=-1)
     parser.add_argument("--to_frame", metavar="INT", help="the last frame to process (incl.); ignored if <= 0", required=False, type=int, default=-1)
     parser.add_argument("--prune", help="whether to prune the images if not enough change", action="store_true", required=False)
-    parser.add_argument("--bw_threshold", metavar="INT", default=128, type=int, help="The threshold (0-255) for the black/white conversion (requires --prune)")
+    parser.add_argument("--bw_threshold", metavar="INT", default=128, type=int, help="The threshold (0-255) for the black/white conversion (requires --prune or --adaptive_skip)")
     parser.add_argument("--change_threshold", metavar="FLOAT", default=0.0, type=float, help="The threshold (0.0-1.0) for the change detection (requires --prune)")
+    parser.add_argument("--prune_scale", metavar="FLOAT", default=1.0, type=float, help="The scale factor to apply to the frames before the change detection, e.g., 0.25 for a quarter of the width/height (requires --prune or --adaptive_skip)")
+    parser.add_argument("--adaptive_skip", help="whether to select the frames based on the change accumulated since the last selected frame rather than every nth frame (--nth_frame gets ignored)", action="store_true", required=False)
+    parser.add_argument("--skip_min", metavar="INT", default=0, type=int, help="The minimum number of frames to skip after a selected frame (requires --adaptive_skip)")
+    parser.add_argument("--skip_max", metavar="INT", default=-1, type=int, help="The maximum number of frames to skip after a selected frame; ignored if <= 0 (requires --adaptive_skip)")
+    parser.add_argument("--skip_lambda", metavar="FLOAT", default=0.5, type=float, help="The accumulated change ratio at which to select the next frame (requires --adaptive_skip)")
+    parser.add_argument("--opencl", help="whether to use OpenCL (if available) for the change detection (--prune/--adaptive_skip)", action="store_true", required=False)
     parser.add_argument('--redis_host', metavar='HOST', required=False, default="localhost", help='The redis server to connect to')
     parser.add_argument('--redis_port', metavar='PORT', required=False, default=6379, type=int, help='The port the redis server is listening on')
     parser.add_argument('--redis_db', metavar='DB', required=False, default=0, type=int, help='The redis database to use')
@@ -382,19 +509,25 @@ def main(args=None):
     parser.add_argument('--redis_in', metavar='CHANNEL', required=True, type=str, help='The redis channel to receive the predictions on')
     parser.add_argument("--redis_timeout", metavar="SECONDS", help="the maximum number of seconds to wait for the image analysis to finish processing", required=False, type=float, default=10)
     parser.add_argument("--analysis_type", help="the type of output the analysis process generates", choices=ANALYSIS_TYPES, required=False, default=ANALYSIS_TYPES[0])
+    parser.add_argument("--analysis_max_dim", metavar="INT", help="the maximum width/height of the frames sent to the image analysis, larger frames get scaled down (predictions get scaled back up for cropping); no scaling if <= 0", required=False, type=int, default=-1)
+    parser.add_argument("--analysis_jpeg_quality", metavar="INT", help="the quality (0-100) to use for encoding the frames sent to the image analysis; uses --jpeg_quality if < 0", required=False, type=int, default=-1)
     parser.add_argument("--min_score", metavar="FLOAT", help="the minimum score that a prediction must have", required=False, type=float, default=0.0)
     parser.add_argument("--required_labels", metavar="LIST", help="the comma-separated list of labels that the analysis output must contain (with high enough scores)", required=False)
     parser.add_argument("--excluded_labels", metavar="LIST", help="the comma-separated list of labels that the analysis output must not contain (with high enough scores)", required=False)
     parser.add_argument("--output", metavar="DIR_OR_FILE", help="the output directory or file for storing the selected frames (use .avi or .mkv for videos)", required=True)
     parser.add_argument("--output_type", help="the type of output to generate", choices=OUTPUT_TYPES, required=True)
     parser.add_argument("--output_format", metavar="FORMAT", help="the format string for the images, see https://docs.python.org/3/library/stdtypes.html#old-string-formatting", required=False, default="%06d.jpg")
-    parser.add_argument("--output_tmp", metavar="DIR", help="the temporary directory to write the output images to before moving them to the output directory (to avoid race conditions with processes that pick up the images)", required=False)
+    parser.add_argument("--output_tmp", metavar="DIR", help="the temporary directory to write the output images to before moving them to the output directory (to avoid race conditions with processes that pick up the images; must be on the same filesystem)", required=False)
     parser.add_argument("--output_fps", metavar="FORMAT", help="the frames per second to use when generating a video", required=False, type=int, default=25)
+    parser.add_argument("--jpeg_quality", metavar="INT", help="the quality (0-100) to use when encoding JPEG images", required=False, type=int, default=JPEG_QUALITY)
+    parser.add_argument("--jpeg_optimize", help="whether to use optimized Huffman tables for the output JPEG images (smaller files, slightly slower encoding)", action="store_true", required=False)
+    parser.add_argument("--num_writers", metavar="INT", help="the number of threads to use for writing the output images in the background (<= 1 for no background threads)", required=False, type=int, default=1)
     parser.add_argument("--crop_to_content", help="whether to crop the frame to the detected content", action="store_true", required=False)
     parser.add_argument("--crop_margin", metavar="INT", help="the margin in pixels to use around the determined crop region", required=False, type=int, default=0)
     parser.add_argument("--crop_min_width", metavar="INT", help="the minimum width for the cropped content", required=False, type=int, default=2)
     parser.add_argument("--crop_min_height", metavar="INT", help="the minimum height for the cropped content", required=False, type=int, default=2)
-    parser.add_argument("--output_metadata", help="whether to output a YAML file alongside the image with some metadata when outputting frame images", required=False, action="store_true")
+    parser.add_argument("--output_metadata", help="whether to output a YAML/JSON file alongside the image with some metadata when outputting frame images", required=False, action="store_true")
+    parser.add_argument("--metadata_format", help="the format to use for the metadata files (json uses orjson if installed)", choices=METADATA_FORMATS, required=False, default=METADATA_YAML)
     parser.add_argument("--progress", metavar="INT", help="every nth frame a progress message is output on stdout", required=False, type=int, default=100)
     parser.add_argument("--keep_original", help="keeps the original file name when processing an image dir", action="store_true", required=False)
     parser.add_argument("--verbose", help="for more verbose output", action="store_true", required=False)
@@ -403,10 +536,10 @@ def main(args=None):
     # parse labels
     required_labels = None
     if parsed.required_labels is not None:
-        required_labels = parsed.required_labels.split(",")
+        required_labels = frozenset(parsed.required_labels.split(","))
     excluded_labels = None
     if parsed.excluded_labels is not None:
-        excluded_labels = parsed.excluded_labels.split(",")
+        excluded_labels = frozenset(parsed.excluded_labels.split(","))
 
     # setup redis connection
     redis_conn = RedisConnection()
@@ -415,16 +548,27 @@ def main(args=None):
     redis_conn.channel_out = parsed.redis_out
     redis_conn.timeout = parsed.redis_timeout
 
-    process(input=parsed.input, input_type=parsed.input_type, nth_frame=parsed.nth_frame, max_frames=parsed.max_frames,
-            redis_conn=redis_conn, analysis_type=parsed.analysis_type,
-            from_frame=parsed.from_frame, to_frame=parsed.to_frame,
-            min_score=parsed.min_score, required_labels=required_labels, excluded_labels=excluded_labels,
-            output=parsed.output, output_type=parsed.output_type, output_format=parsed.output_format,
-            output_tmp=parsed.output_tmp, output_fps=parsed.output_fps, output_metadata=parsed.output_metadata,
-            crop_to_content=parsed.crop_to_content, crop_margin=parsed.crop_margin,
-            crop_min_width=parsed.crop_min_width, crop_min_height=parsed.crop_min_height,
-            verbose=parsed.verbose, progress=parsed.progress, keep_original=parsed.keep_original,
-            prune=parsed.prune, bw_threshold=parsed.bw_threshold, change_threshold=parsed.change_threshold)
+    try:
+        process(input=parsed.input, input_type=parsed.input_type, nth_frame=parsed.nth_frame, max_frames=parsed.max_frames,
+                redis_conn=redis_conn, analysis_type=parsed.analysis_type,
+                from_frame=parsed.from_frame, to_frame=parsed.to_frame,
+                min_score=parsed.min_score, required_labels=required_labels, excluded_labels=excluded_labels,
+                output=parsed.output, output_type=parsed.output_type, output_format=parsed.output_format,
+                output_tmp=parsed.output_tmp, output_fps=parsed.output_fps, output_metadata=parsed.output_metadata,
+                jpeg_quality=parsed.jpeg_quality, jpeg_optimize=parsed.jpeg_optimize,
+                num_writers=parsed.num_writers,
+                crop_to_content=parsed.crop_to_content, crop_margin=parsed.crop_margin,
+                crop_min_width=parsed.crop_min_width, crop_min_height=parsed.crop_min_height,
+                verbose=parsed.verbose, progress=parsed.progress, keep_original=parsed.keep_original,
+                prune=parsed.prune, bw_threshold=parsed.bw_threshold, change_threshold=parsed.change_threshold,
+                prune_scale=parsed.prune_scale, hw_decode=parsed.hw_decode, adaptive_skip=parsed.adaptive_skip,
+                skip_min=parsed.skip_min, skip_max=parsed.skip_max, skip_lambda=parsed.skip_lambda,
+                opencl=parsed.opencl, decoder=parsed.decoder,
+                prefetch=parsed.prefetch, metadata_format=parsed.metadata_format,
+                analysis_max_dim=parsed.analysis_max_dim, analysis_jpeg_quality=parsed.analysis_jpeg_quality,
+                capture_buffer=parsed.capture_buffer, scan_threads=parsed.scan_threads)
+    finally:
+        redis_conn.close()
 
 
 def sys_main():
@@ -1,4 +1,7 @@
 import cv2
+import filecmp
+
+from vfs.logging import log
 
 
 def diff_img(img1, img2):
@@ -11,15 +14,20 @@ def diff_img(img1, img2):
     return cv2.absdiff(img1, img2)
 
 
-def to_bw(img, threshold):
+def to_bw(img, threshold, in_place=False):
     """
     Turns the gray image into binary.
 
     :param img: the image to convert
     :param threshold: the threshold to use
     :type threshold: int
+    :param in_place: whether to overwrite the image with the binary one rather than allocating a new image
+    :type in_place: bool
     :return: the binary image
     """
+    if in_place:
+        cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY, dst=img)
+        return img
     thresh, binary = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
     return binary
 
@@ -35,6 +43,84 @@ def count_diff(img):
     return cv2.countNonZero(img)
 
 
+def enable_opencl(verbose=False):
+    """
+    Enables OpenCV's OpenCL backend, if available.
+
+    :param verbose: whether to be verbose
+    :type verbose: bool
+    :return: whether OpenCL is available and got enabled
+    :rtype: bool
+    """
+    if not cv2.ocl.haveOpenCL():
+        log("OpenCL not available!")
+        return False
+    cv2.ocl.setUseOpenCL(True)
+    if verbose:
+        log("OpenCL enabled: %s" % cv2.ocl.Device.getDefault().name())
+    return True
+
+
+def same_file(path1, path2):
+    """
+    Checks whether the two files have the same content, without decoding them.
+    Compares the file sizes first and the content only if they are the same.
+
+    :param path1: the first file
+    :type path1: str
+    :param path2: the second file
+    :type path2: str
+    :return: whether the content is identical
+    :rtype: bool
+    """
+    return filecmp.cmp(path1, path2, shallow=False)
+
+
+def prepare_image(img, scale=1.0, use_umat=False):
+    """
+    Prepares the image for change detection by turning it into a gray image
+    (optionally downscaling it first). The result can be cached and used with
+    detect_change_prepared, to avoid converting the same image multiple times.
+
+    :param img: the image to prepare
+    :param scale: the scale factor to apply, e.g., 0.25 for a quarter of the width/height; ignored if 1.0
+    :type scale: float
+    :param use_umat: whether to process the image as UMat, i.e., via OpenCL if enabled (see enable_opencl)
+    :type use_umat: bool
+    :return: the gray image
+    """
+    if use_umat:
+        img = cv2.UMat(img)
+    if scale != 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def detect_change_prepared(gray1, gray2, bw_threshold, change_threshold):
+    """
+    Returns true if there was change detected between the two images that were
+    prepared with prepare_image.
+
+    :param gray1: the first gray image
+    :param gray2: the second gray image
+    :param bw_threshold: the black/white threshold (0-255)
+    :type bw_threshold: int
+    :param change_threshold: the threshold for changes (0-1)
+    :type change_threshold: float
+    :return: the detected ratio, whether change was detected
+    :rtype threshold: (float, bool)
+    """
+    # the difference image is only an intermediate result, no need to allocate another image for the binary one
+    bw = to_bw(diff_img(gray1, gray2), bw_threshold, in_place=True)
+    # like detect_change, the ratio is relative to the size of the BGR image
+    if isinstance(bw, cv2.UMat):
+        # UMat does not expose its size, the mean of the binary image is the fraction of changed pixels
+        ratio = cv2.mean(bw)[0] / 255.0 / 3.0
+    else:
+        ratio = float(count_diff(bw)) / float(gray1.size * 3)
+    return ratio, ratio > change_threshold
+
+
 def detect_change(img1, img2, bw_threshold, change_threshold):
     """
     Returns true if there was change detected between the two images (turns them into gray images first).
@@ -48,9 +134,63 @@ def detect_change(img1, img2, bw_threshold, change_threshold):
     :return: the detected ratio, whether change was detected
     :rtype threshold: (float, bool)
     """
-    size = img1.size
-    img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-    img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
-    count = count_diff(to_bw(diff_img(img1, img2), bw_threshold))
-    ratio = float(count) / float(size)
-    return ratio, ratio > change_threshold
+    return detect_change_prepared(prepare_image(img1), prepare_image(img2), bw_threshold, change_threshold)
+
+
+class AdaptiveSkipper(object):
+    """
+    Selects frames based on the change accumulated since the last selected
+    frame, rather than selecting every n-th frame.
+    """
+
+    def __init__(self, bw_threshold, skip_min, skip_max, skip_lambda, scale=1.0, use_umat=False):
+        """
+        Initializes the skipper.
+
+        :param bw_threshold: the threshold (0-255) for the black/white conversion
+        :type bw_threshold: int
+        :param skip_min: the minimum number of frames to skip after a selected frame
+        :type skip_min: int
+        :param skip_max: the maximum number of frames to skip after a selected frame, ignored if <= 0
+        :type skip_max: int
+        :param skip_lambda: the accumulated change ratio at which to select the next frame
+        :type skip_lambda: float
+        :param scale: the scale factor to apply to the frames before the change detection
+        :type scale: float
+        :param use_umat: whether to process the frames as UMat, i.e., via OpenCL if enabled
+        :type use_umat: bool
+        """
+        self.bw_threshold = bw_threshold
+        self.skip_min = skip_min
+        self.skip_max = skip_max
+        self.skip_lambda = skip_lambda
+        self.scale = scale
+        self.use_umat = use_umat
+        self.gray_ref = None
+        self.accumulated = 0.0
+        self.skipped = 0
+
+    def select(self, frame):
+        """
+        Determines whether the frame should get selected. Selected frames become the new reference.
+
+        :param frame: the frame to check
+        :return: whether to select the frame
+        :rtype: bool
+        """
+        if self.gray_ref is not None:
+            self.skipped += 1
+            # avoid the change detection altogether if the frame would get skipped anyway
+            if self.skipped <= self.skip_min:
+                return False
+        gray = prepare_image(frame, scale=self.scale, use_umat=self.use_umat)
+        if self.gray_ref is not None:
+            if (self.skip_max <= 0) or (self.skipped <= self.skip_max):
+                ratio, _ = detect_change_prepared(self.gray_ref, gray, self.bw_threshold, 0.0)
+                self.accumulated += ratio
+                if self.accumulated <= self.skip_lambda:
+                    return False
+        self.gray_ref = gray
+        self.accumulated = 0.0
+        self.skipped = 0
+        return True